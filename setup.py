@@ -42,10 +42,15 @@ setup(
     url="https://shiptoasting.tech.ccp.is/",
     entry_points={
         "paste.app_factory": ["main = shiptoasting.web:production"],
-        "console_scripts": ["shiptoasting-dev = shiptoasting.web:development"],
+        "console_scripts": [
+            "shiptoasting-dev = shiptoasting.web:development",
+            "shiptoasting-asgi-dev = shiptoasting.asgi:development",
+            "shiptoasting-sim = shiptoasting.simulation:main",
+            "shiptoasting-search-bench = shiptoasting.search:main",
+        ],
     },
     install_requires=REQUIRES,
-    extras_require={"deploy": ["gunicorn"]},
+    extras_require={"deploy": ["gunicorn"], "asgi": ["uvicorn"]},
     include_package_data=True,
     zip_safe=False,
     package_data={
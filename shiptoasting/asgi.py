@@ -0,0 +1,285 @@
+"""ShipToasting native asyncio (ASGI) frontend.
+
+Serves the /shiptoasts stream straight from the event loop, everything else
+is handed to the Flask app in a worker thread.
+"""
+
+
+import io
+import sys
+import atexit
+import asyncio
+import threading
+from urllib.parse import parse_qs
+
+from shiptoasting import app
+from shiptoasting.storage import ShipToasts
+from shiptoasting.storage import AsyncShipToaster
+from shiptoasting.storage import normalize_channel
+from shiptoasting.web import EventEncoder
+
+
+def _wsgi_environ(scope, body):
+    """Builds a WSGI environ dictionary from an ASGI http scope."""
+
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode(
+            "latin-1"
+        ),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_{}".format(name)
+        if name in environ:
+            value = "{},{}".format(environ[name], value)
+        environ[name] = value
+
+    return environ
+
+
+def _query_args(scope):
+    """Returns the query arguments of the request as a dictionary."""
+
+    return {
+        key: values[0] for key, values in
+        parse_qs(scope.get("query_string", b"").decode("latin-1")).items()
+    }
+
+
+def _header(scope, name):
+    """Returns the value of a request header, or an empty string."""
+
+    for key, value in scope.get("headers", []):
+        if key.decode("latin-1").lower() == name:
+            return value.decode("latin-1")
+    return ""
+
+
+def _last_seen_id(query):
+    """Returns the last_seen query argument as an int, or None."""
+
+    last_seen_id = query.get("last_seen", "None")
+    if last_seen_id == "None":
+        return None
+    return int(last_seen_id)
+
+
+async def _wait_for_disconnect(receive):
+    """Consumes ASGI messages until the client disconnects."""
+
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class ShipToastingASGI(object):
+    """ASGI application wrapping the Flask app."""
+
+    def __init__(self, wsgi_app, reconcile_interval=30):
+        self.wsgi_app = wsgi_app
+        self.reconcile_interval = reconcile_interval
+        self._periodic = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] != "http":
+            raise ValueError("Unsupported scope: {}".format(scope["type"]))
+        elif scope["path"] == "/shiptoasts":
+            await self._stream(scope, receive, send)
+        else:
+            await self._wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        """Starts and stops the periodic cache maintenance."""
+
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._periodic = asyncio.ensure_future(self._periodic_call())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._periodic is not None:
+                    self._periodic.cancel()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _periodic_call(self):
+        """Runs ShipToasts.periodic_call in a worker thread on an interval."""
+
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            await loop.run_in_executor(None, app.shiptoasts.periodic_call)
+
+    async def _stream(self, scope, receive, send):
+        """Streams shiptoasts as server-sent events until disconnected."""
+
+        query = _query_args(scope)
+        try:
+            last_seen_id = _last_seen_id(query)
+            channel = normalize_channel(query.get("channel"))
+        except ValueError:
+            await self._respond(send, 400, [], [b"Bad Request"])
+            return
+
+        # the first stream of a channel fills it from datastore
+        await asyncio.get_event_loop().run_in_executor(
+            None,
+            app.shiptoasts.channel,
+            channel,
+        )
+        encoder = EventEncoder.from_request(
+            query.get("mode"),
+            _header(scope, "accept-encoding"),
+        )
+        toaster = AsyncShipToaster(last_seen_id, channel,
+                                   resends=encoder.compact)
+        headers = [(b"content-type", b"text/event-stream; charset=utf-8")]
+        headers.extend(
+            (key.lower().encode("latin-1"), value.encode("latin-1"))
+            for key, value in encoder.headers.items()
+        )
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": headers,
+        })
+
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            while True:
+                update = asyncio.ensure_future(toaster.next_update())
+                await asyncio.wait(
+                    [update, disconnected],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if disconnected.done():
+                    update.cancel()
+                    break
+                await send({
+                    "type": "http.response.body",
+                    "body": encoder.encode(update.result()),
+                    "more_body": True,
+                })
+        finally:
+            disconnected.cancel()
+            toaster.close()
+
+    async def _wsgi(self, scope, receive, send):
+        """Runs the Flask app for the request in a worker thread."""
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        environ = _wsgi_environ(scope, b"".join(body))
+        status, headers, chunks = await asyncio.get_event_loop(
+        ).run_in_executor(None, self._run_wsgi, environ)
+        await self._respond(send, status, headers, chunks)
+
+    def _run_wsgi(self, environ):
+        """Calls the WSGI app, returns the status, headers and body chunks."""
+
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [
+                (key.lower().encode("latin-1"), value.encode("latin-1"))
+                for key, value in headers
+            ]
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                chunks.append(chunk)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        return response["status"], response["headers"], chunks
+
+    @staticmethod
+    async def _respond(send, status, headers, chunks):
+        """Sends a complete, non-streaming response."""
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers,
+        })
+        await send({"type": "http.response.body", "body": b"".join(chunks)})
+
+
+def production(*_, **settings):
+    """Returns the ASGI app, with the shared ShipToasts running.
+
+    Only the reconcile_interval setting (in seconds) is used.
+    """
+
+    app.shiptoasts = ShipToasts()
+    if app.shiptoasts.load_snapshot():
+        target = app.shiptoasts.warm_start
+    else:
+        app.shiptoasts.connect()
+        app.shiptoasts.initial_fill()
+        target = app.shiptoasts.listen_for_updates
+
+    listener = threading.Thread(
+        target=target,
+        name="shiptoasts-listener",
+        daemon=True,
+    )
+    listener.start()
+    threading.Thread(
+        target=app.shiptoasts.backfill_index,
+        name="shiptoasts-backfill",
+        daemon=True,
+    ).start()
+    atexit.register(app.shiptoasts.save_snapshot)
+    atexit.register(app.shiptoasts.save_index)
+
+    return ShipToastingASGI(
+        app,
+        reconcile_interval=int(settings.get("reconcile_interval", 30)),
+    )
+
+
+def development():
+    """Debug/cmdline entry point, requires uvicorn."""
+
+    import uvicorn
+
+    uvicorn.run(production(), host="0.0.0.0", port=8080, log_level="debug")
+
+
+if __name__ == "__main__":
+    development()
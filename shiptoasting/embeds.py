@@ -0,0 +1,241 @@
+"""Link preview (oEmbed) resolution, done outside of the request path."""
+
+
+import os
+import html
+import json
+import time
+import queue
+import logging
+import threading
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
+
+import requests
+from bs4 import BeautifulSoup
+
+from shiptoasting.formatting import plain_links
+
+
+EMBED_TTL = int(os.environ.get("SHIPTOASTS_EMBED_TTL", 3600))
+EMBED_CACHE_MAX = int(os.environ.get("SHIPTOASTS_EMBED_CACHE_MAX", 10000))
+EMBED_TIMEOUT = float(os.environ.get("SHIPTOASTS_EMBED_TIMEOUT", 5))
+OEMBED_PROVIDERS = [  # link prefix, oEmbed endpoint
+    ["https://vimeo.com/", "https://vimeo.com/api/oembed.json"],
+    ["https://soundcloud.com/", "https://soundcloud.com/oembed"],
+    ["https://www.flickr.com/", "https://www.flickr.com/services/oembed/"],
+]
+
+
+if os.environ.get("SHIPTOASTS_OEMBED_PROVIDERS"):
+    OEMBED_PROVIDERS = json.loads(os.environ["SHIPTOASTS_OEMBED_PROVIDERS"])
+
+
+def normalize_url(link):
+    """Returns link with tracking parameters and fragment removed."""
+
+    parts = urlsplit(link)
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query)
+        if not key.startswith("utm_")
+    ]
+    return urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path or "/",
+        urlencode(query),
+        "",
+    ))
+
+
+def _oembed_html(link, response):
+    """Builds our own embed markup from an oEmbed response.
+
+    Provider html is never used as is, only an https iframe src from it.
+
+    Returns:
+        html string, or None if there's nothing better than a plain link
+    """
+
+    embed_type = response.get("type")
+    title = html.escape(str(response.get("title") or link))
+    width = min(int(response.get("width") or 480), 500)
+    height = min(int(response.get("height") or 390), 500)
+
+    if embed_type == "photo" and response.get("url"):
+        return '<a href="{}"><img src="{}" alt="{}" /></a>'.format(
+            link,
+            html.escape(response["url"]),
+            title,
+        )
+    elif embed_type in ("video", "rich"):
+        iframe = BeautifulSoup(
+            response.get("html") or "",
+            "html.parser",
+        ).find("iframe")
+        if iframe and iframe.get("src", "").startswith("https://"):
+            return (
+                '<iframe title="{}" width="{}" height="{}" src="{}" '
+                'frameborder="0" allowfullscreen></iframe>'
+            ).format(title, width, height, html.escape(iframe["src"]))
+
+    if response.get("title"):
+        return '<a href="{}">{}</a>'.format(link, title)
+
+
+class OEmbedProvider(object):
+    """Resolves links starting with prefix using an oEmbed endpoint."""
+
+    def __init__(self, prefix, endpoint, timeout=EMBED_TIMEOUT):
+        self.prefix = prefix
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def match(self, link):
+        """Returns a boolean of if this provider handles the link."""
+
+        return link.startswith(self.prefix)
+
+    def resolve(self, link):
+        """Returns the embed html for link, or None."""
+
+        res = requests.get(
+            self.endpoint,
+            params={
+                "url": html.unescape(link),
+                "format": "json",
+                "maxwidth": 500,
+            },
+            timeout=self.timeout,
+        )
+        res.raise_for_status()
+        return _oembed_html(link, res.json())
+
+
+class EmbedCache(object):
+    """Bounded TTL cache of resolved embeds, keyed by normalized url.
+
+    clock returns the current timestamp.
+    """
+
+    def __init__(self, ttl=EMBED_TTL, max_size=EMBED_CACHE_MAX,
+                 clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._entries = {}  # normalized url: (expires, html or None)
+
+    def __contains__(self, link):
+        entry = self._entries.get(normalize_url(link))
+        return entry is not None and entry[0] > self._clock()
+
+    def get(self, link):
+        """Returns the cached embed html for link, or None."""
+
+        # one lookup, put may replace the entries from the worker thread
+        entry = self._entries.get(normalize_url(link))
+        if entry is not None and entry[0] > self._clock():
+            return entry[1]
+
+    def put(self, link, embedded):
+        """Caches the embed html (or None, for nothing to embed) for link."""
+
+        now = self._clock()
+        if len(self._entries) >= self.max_size:
+            self._entries = {
+                key: entry for key, entry in self._entries.items()
+                if entry[0] > now
+            }
+            while len(self._entries) >= self.max_size:
+                self._entries.pop(next(iter(self._entries)))
+        self._entries[normalize_url(link)] = (now + self.ttl, embedded)
+
+
+class EmbedResolver(object):
+    """Pipeline of providers, run by a background worker thread.
+
+    Callbacks are called from the worker thread with a dictionary of
+    {link: embed html} for every link that resolved to something.
+    """
+
+    def __init__(self, providers=None, cache=None):
+        if providers is None:
+            providers = [OEmbedProvider(*prov) for prov in OEMBED_PROVIDERS]
+        self.providers = providers
+        self.cache = cache or EmbedCache()
+        self._jobs = queue.Queue()
+        self._worker = None
+
+    def _provider(self, link):
+        """Returns the first provider matching link, or None."""
+
+        for provider in self.providers:
+            if provider.match(link):
+                return provider
+
+    def cached(self, formatted):
+        """Returns the cached embeds for the plain links in a message."""
+
+        embeds = {}
+        for link in plain_links(formatted):
+            embedded = self.cache.get(link)
+            if embedded:
+                embeds[link] = embedded
+        return embeds
+
+    def submit(self, formatted, callback):
+        """Queues lookups for the message's uncached links, if any.
+
+        Returns:
+            boolean of if anything was queued
+        """
+
+        links = [link for link in plain_links(formatted)
+                 if link not in self.cache and self._provider(link)]
+        if not links:
+            return False
+
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(
+                target=self._work,
+                name="shiptoasts-embeds",
+                daemon=True,
+            )
+            self._worker.start()
+
+        self._jobs.put((links, callback))
+        return True
+
+    def resolve(self, link):
+        """Resolves a single link, memoizing the result."""
+
+        if link in self.cache:
+            return self.cache.get(link)
+
+        embedded = None
+        provider = self._provider(link)
+        if provider is not None:
+            try:
+                embedded = provider.resolve(link)
+            except (requests.RequestException, TypeError, ValueError) as err:
+                logging.info("could not resolve embed for %s: %r", link, err)
+        self.cache.put(link, embedded)
+        return embedded
+
+    def _work(self):
+        """Worker loop, resolves queued links and calls back with them."""
+
+        while True:
+            links, callback = self._jobs.get()
+            embeds = {}
+            for link in links:
+                embedded = self.resolve(link)
+                if embedded:
+                    embeds[link] = embedded
+            if embeds:
+                try:
+                    callback(embeds)
+                except Exception as error:
+                    logging.warning("embed callback failed: %r", error)
@@ -8,6 +8,7 @@ url_pattern = re.compile(
     "((https?):((//)|(\\\\))+([\w\d:#@%/;$()~_?\+-=\\\.&](#!)?)*)"
 )
 gfycat_pattern = re.compile("(https?)://gfycat.com/[^/]*")
+plain_link_pattern = re.compile('<a href="([^"]*)">([^<]*)</a>')
 
 
 def _youtube_embed(youtube_link):
@@ -60,38 +61,90 @@ def _gfycat_embed(gfycat_link):
     )
 
 
+def _gfycat(link):
+    """Embeds gfycat links as videos."""
+
+    gfycat_match = re.match(gfycat_pattern, link)
+    if gfycat_match:
+        return _gfycat_embed(link[:gfycat_match.end()])
+
+
+def _youtube(link):
+    """Embeds youtube links in an iframe."""
+
+    if "youtube.com/watch?v=" in link:
+        return _youtube_embed(
+            link.split("youtube.com/watch?v=")[-1].split("&")[0]
+        )
+    elif "youtu.be/" in link:
+        return _youtube_embed(link.split("youtu.be/")[-1].split("?")[0])
+
+
+def _image(link):
+    """Embeds links to images as images."""
+
+    image_endings = ("jpeg", "JPEG", "jpg", "JPG", "gif", "GIF", "png", "PNG")
+    if link.split(".")[-1] in image_endings:
+        return '<a href="{}"><img src="{}" /></a>'.format(link, link)
+
+
+def _gifv(link):
+    """Embeds imgur gifv links as videos."""
+
+    if "imgur" in link and link.split(".")[-1] in ("gifv", "GIFV"):
+        return _gifv_embed(link)
+
+
+# embedders are tried in order, the first to return html for a link wins
+EMBEDDERS = [_gfycat, _youtube, _image, _gifv]
+
+
+def link_html(link):
+    """Returns the plain <a> tag used for links without an embed."""
+
+    return '<a href="{}">{}</a>'.format(link, link)
+
+
 def format_message(message):
     """Adds <a> tags to links, turn image links into <img> tags."""
 
-    image_endings = ("jpeg", "JPEG", "jpg", "JPG", "gif", "GIF", "png", "PNG")
     formatted = []
     last_match = 0
     for match in re.finditer(url_pattern, message):
         span = match.span()
         formatted.append(message[last_match:span[0]])
         link = message[span[0]:span[1]]
-        link_extension = link.split(".")[-1]
-        gfycat_match = re.match(gfycat_pattern, link)
-        if gfycat_match:
-            formatted.append(_gfycat_embed(link[:gfycat_match.end()]))
-        elif "youtube.com/watch?v=" in link:
-            formatted.append(_youtube_embed(
-                link.split("youtube.com/watch?v=")[-1].split("&")[0]
-            ))
-        elif "youtu.be/" in link:
-            formatted.append(_youtube_embed(
-                link.split("youtu.be/")[-1].split("?")[0]
-            ))
-        elif link_extension in image_endings:
-            formatted.append(
-                '<a href="{}"><img src="{}" /></a>'.format(link, link)
-            )
-        elif "imgur" in link and link_extension in ("gifv", "GIFV"):
-            formatted.append(_gifv_embed(link))
+        for embedder in EMBEDDERS:
+            embedded = embedder(link)
+            if embedded:
+                formatted.append(embedded)
+                break
         else:
-            formatted.append('<a href="{}">{}</a>'.format(link, link))
+            formatted.append(link_html(link))
 
         last_match = span[1]
 
     formatted.append(message[last_match:])
     return "".join(formatted)
+
+
+def plain_links(formatted):
+    """Returns the links in a formatted message that weren't embedded."""
+
+    return [
+        match.group(1) for match in re.finditer(plain_link_pattern, formatted)
+        if match.group(1) == match.group(2)
+    ]
+
+
+def apply_embeds(formatted, embeds):
+    """Replaces plain links in a formatted message with their embeds.
+
+    Args:
+        formatted: message as returned from format_message
+        embeds: dictionary of {link: embed html}
+    """
+
+    for link, embedded in embeds.items():
+        formatted = formatted.replace(link_html(link), embedded)
+    return formatted
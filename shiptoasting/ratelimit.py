@@ -0,0 +1,141 @@
+"""Cluster-wide rate limiting of shiptoasts per author."""
+
+
+import os
+import time
+import bisect
+import logging
+import threading
+
+import redis
+
+
+RATE_LIMIT = int(os.environ.get("SHIPTOASTS_RATE_LIMIT", 2))
+RATE_WINDOW = float(os.environ.get("SHIPTOASTS_RATE_WINDOW", 30))
+REDIS_URL = os.environ.get("REDIS_URL")
+REDIS_KEY = "shiptoasting:posts"
+
+
+class RateLimiter(object):
+    """Sliding window limit of posts per author_id.
+
+    Checks only ever look at local state, so they're cheap. Posts are
+    recorded locally when accepted here and when received from other pods.
+    If a redis url is set, a background thread pushes the posts accepted
+    here to a shared sorted set and pulls back every post from the window,
+    which covers pubsub lag and loss, and authors new to this pod.
+
+    Posts are identified by (author_id, timestamp), so the same post seen
+    from several places is only counted once. The sync thread and callers
+    share state under self._lock. clock returns the current timestamp.
+    """
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW,
+                 redis_url=REDIS_URL, sync_interval=1, clock=time.time):
+        self.limit = limit
+        self.window = window
+        self.sync_interval = sync_interval
+        self._clock = clock
+        self._posts = {}  # author_id: sorted list of post timestamps
+        self._pending = []  # (author_id, timestamp) to push to redis
+        self._redis = None
+        self._syncer = None
+        self._lock = threading.Lock()
+        if redis_url:
+            self._redis = redis.StrictRedis.from_url(redis_url)
+            self._start_syncing()
+
+    def _recent(self, author_id, now):
+        """Returns the author's post timestamps, pruned to the window."""
+
+        posts = self._posts.setdefault(author_id, [])
+        del posts[:bisect.bisect_right(posts, now - self.window)]
+        return posts
+
+    def _add(self, author_id, timestamp):
+        """Adds a post to the author's window, unless it's already there."""
+
+        now = self._clock()
+        posts = self._recent(author_id, now)
+        if timestamp not in posts and timestamp > now - self.window:
+            bisect.insort(posts, timestamp)
+
+    def allow(self, author_id, timestamp):
+        """Checks and records a new post from author_id.
+
+        Returns:
+            boolean of if the post is within the limit
+        """
+
+        with self._lock:
+            if len(self._recent(author_id, timestamp)) >= self.limit:
+                return False
+
+            self._add(author_id, timestamp)
+            if self._redis is not None:
+                self._pending.append((author_id, timestamp))
+            return True
+
+    def record(self, author_id, timestamp):
+        """Records a post accepted elsewhere (or already allowed here)."""
+
+        with self._lock:
+            self._add(author_id, timestamp)
+
+    def prune(self):
+        """Drops authors without any posts inside the window."""
+
+        now = self._clock()
+        with self._lock:
+            for author_id in list(self._posts):
+                if not self._recent(author_id, now):
+                    self._posts.pop(author_id, None)
+
+    def _start_syncing(self):
+        """Starts the background redis sync thread."""
+
+        self._syncer = threading.Thread(
+            target=self._sync_forever,
+            name="shiptoasts-ratelimit",
+            daemon=True,
+        )
+        self._syncer.start()
+
+    def _sync_forever(self):
+        """Syncs with redis every sync_interval seconds."""
+
+        while True:
+            self.sync()
+            time.sleep(self.sync_interval)
+
+    def sync(self):
+        """Pushes our new posts to redis, pulls in every pod's posts."""
+
+        if self._redis is None:
+            return
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        cutoff = self._clock() - self.window
+
+        pipe = self._redis.pipeline(transaction=False)
+        if pending:
+            pipe.zadd(REDIS_KEY, {
+                "{}:{!r}".format(author_id, timestamp): timestamp
+                for author_id, timestamp in pending
+            })
+        pipe.zremrangebyscore(REDIS_KEY, "-inf", cutoff)
+        pipe.zrangebyscore(REDIS_KEY, cutoff, "+inf")
+
+        try:
+            posted = pipe.execute()[-1]
+        except redis.RedisError as error:
+            logging.warning("could not sync rate limits: %r", error)
+            with self._lock:
+                self._pending[:0] = pending
+            return
+
+        with self._lock:
+            for member in posted:
+                author_id, timestamp = member.decode("utf-8").rsplit(":", 1)
+                self._add(int(author_id), float(timestamp))
@@ -0,0 +1,751 @@
+"""Full-text search over shiptoast authors and content."""
+
+
+import os
+import re
+import sys
+import gzip
+import html
+import json
+import math
+import time
+import fcntl
+import heapq
+import bisect
+import random
+import logging
+import argparse
+import tempfile
+import itertools
+import threading
+from array import array
+from collections import OrderedDict
+from collections import namedtuple
+
+
+SEARCH_INDEX = os.environ.get("SHIPTOASTS_SEARCH_INDEX")
+SEARCH_PAGE = int(os.environ.get("SHIPTOASTS_SEARCH_PAGE", 25))
+SEARCH_CANDIDATES = int(os.environ.get("SHIPTOASTS_SEARCH_CANDIDATES", 1000))
+SEARCH_PROBES = int(os.environ.get("SHIPTOASTS_SEARCH_PROBES", 50000))
+SEARCH_SEGMENTS = int(os.environ.get("SHIPTOASTS_SEARCH_SEGMENTS", 8))
+AUTHOR_WEIGHT = 2  # term frequency given to each author name token
+BM25_K1 = 1.2
+BM25_B = 0.75
+MANIFEST = "manifest.json"
+
+tag_pattern = re.compile("<[^>]*>")
+token_pattern = re.compile("\\w\\w+")
+segment_pattern = re.compile("^segment-\\d+\\.gz$")
+
+
+def tokenize(text):
+    """Returns the lower cased search tokens in text, ignoring html tags."""
+
+    return token_pattern.findall(
+        html.unescape(tag_pattern.sub(" ", text)).lower()
+    )
+
+
+class Segment(object):
+    """A run of indexed documents with postings of their own.
+
+    Documents are numbered in the order they're added, so each posting list
+    (a pair of arrays: document numbers and term frequencies) stays sorted
+    without any extra work and can be searched with bisect. Documents are
+    added roughly in time order, so walking postings backwards walks from
+    the newest shiptoast. Postings and statistics are kept per channel, so
+    searching one channel never walks another's documents. Segments aren't
+    changed once frozen.
+    """
+
+    def __init__(self):
+        self.name = None  # file name, once written to disk
+        self.ids = array("q")  # document number: shiptoast id
+        self.times = array("d")  # document number: timestamp
+        self.lengths = array("H")  # document number: token count
+        self.channels = array("H")  # document number: channel number
+        self.postings = {}  # channel number: {token: (doc numbers, tfs)}
+        self.stats = {}  # channel number: [documents, total token count]
+        self.newest = 0.0  # timestamp of the newest document
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, shiptoast, channel_number):
+        """Adds a shiptoast as the next document."""
+
+        frequencies = {}
+        for token in tokenize(shiptoast.author):
+            frequencies[token] = frequencies.get(token, 0) + AUTHOR_WEIGHT
+        for token in tokenize(shiptoast.content):
+            frequencies[token] = frequencies.get(token, 0) + 1
+
+        document = len(self.ids)
+        length = min(sum(frequencies.values()), 0xFFFF)
+        self.ids.append(shiptoast.id)
+        self.times.append(shiptoast.timestamp)
+        self.lengths.append(length)
+        self.channels.append(channel_number)
+        self.newest = max(self.newest, shiptoast.timestamp)
+        stats = self.stats.setdefault(channel_number, [0, 0])
+        stats[0] += 1
+        stats[1] += length
+
+        # postings go last, searches may be reading them from other threads
+        postings = self.postings.setdefault(channel_number, {})
+        for token, frequency in frequencies.items():
+            if token not in postings:
+                postings[token] = (array("I"), array("B"))
+            documents, term_frequencies = postings[token]
+            documents.append(document)
+            term_frequencies.append(min(frequency, 0xFF))
+
+    @classmethod
+    def merged(cls, older, newer):
+        """Returns a new segment of older's documents followed by newer's."""
+
+        segment = cls()
+        segment.ids = older.ids + newer.ids
+        segment.times = older.times + newer.times
+        segment.lengths = older.lengths + newer.lengths
+        segment.channels = older.channels + newer.channels
+        segment.newest = max(older.newest, newer.newest)
+
+        offset = len(older)
+        for channel in set(older.stats).union(newer.stats):
+            segment.stats[channel] = [
+                sum(stats) for stats in zip(
+                    older.stats.get(channel, (0, 0)),
+                    newer.stats.get(channel, (0, 0)),
+                )
+            ]
+            older_postings = older.postings.get(channel, {})
+            newer_postings = newer.postings.get(channel, {})
+            postings = segment.postings.setdefault(channel, {})
+            for token in set(older_postings).union(newer_postings):
+                documents, term_frequencies = array("I"), array("B")
+                if token in older_postings:
+                    documents.extend(older_postings[token][0])
+                    term_frequencies.extend(older_postings[token][1])
+                if token in newer_postings:
+                    documents.extend(
+                        map(offset.__add__, newer_postings[token][0])
+                    )
+                    term_frequencies.extend(newer_postings[token][1])
+                postings[token] = (documents, term_frequencies)
+
+        return segment
+
+    def write(self, path, channel_names):
+        """Writes the segment to a compact file at path."""
+
+        postings = sorted(
+            (channel, token)
+            for channel, tokens in self.postings.items()
+            for token in tokens
+        )
+        header = {
+            "byteorder": sys.byteorder,
+            "documents": len(self.ids),
+            "channels": channel_names,
+            "postings": [
+                [channel, token, len(self.postings[channel][token][0])]
+                for channel, token in postings
+            ],
+        }
+
+        temp_file = "{}.tmp".format(path)
+        # postings hardly compress any better at higher levels
+        with gzip.open(temp_file, "wb", compresslevel=1) as opensegment:
+            opensegment.write(json.dumps(header).encode("utf-8"))
+            opensegment.write(b"\n")
+            self.ids.tofile(opensegment)
+            self.times.tofile(opensegment)
+            self.lengths.tofile(opensegment)
+            self.channels.tofile(opensegment)
+            for channel, token in postings:
+                self.postings[channel][token][0].tofile(opensegment)
+                self.postings[channel][token][1].tofile(opensegment)
+        os.replace(temp_file, path)
+
+    @classmethod
+    def read(cls, path, channel_number):
+        """Returns the segment in the file at path.
+
+        Channel numbers are mapped through channel_number, which returns
+        the reader's number for a channel name. Files written before
+        postings were split by channel are split as they're read.
+        """
+
+        segment = cls()
+        postings = {}
+        with gzip.open(path, "rb") as opensegment:
+            header = json.loads(opensegment.readline().decode("utf-8"))
+            documents = header["documents"]
+            swap = header["byteorder"] != sys.byteorder
+
+            def _read(typecode, count):
+                values = array(typecode)
+                values.frombytes(opensegment.read(values.itemsize * count))
+                if len(values) != count:
+                    raise EOFError("truncated search index segment")
+                if swap:
+                    values.byteswap()
+                return values
+
+            segment.ids = _read("q", documents)
+            segment.times = _read("d", documents)
+            segment.lengths = _read("H", documents)
+            if "channels" in header:
+                channel_names = header["channels"]
+                channels = _read("H", documents)
+            else:  # written before channels, all in the default one
+                channel_names = [""]
+                channels = array("H", [0]) * documents
+
+            if "postings" in header:
+                for channel, token, count in header["postings"]:
+                    postings.setdefault(channel, {})[token] = (
+                        _read("I", count),
+                        _read("B", count),
+                    )
+            else:
+                for token, count in header["tokens"]:
+                    for document, frequency in zip(_read("I", count),
+                                                   _read("B", count)):
+                        split = postings.setdefault(channels[document], {})
+                        if token not in split:
+                            split[token] = (array("I"), array("B"))
+                        split[token][0].append(document)
+                        split[token][1].append(frequency)
+
+        numbers = [channel_number(name) for name in channel_names]
+        if numbers != list(range(len(numbers))):
+            channels = array("H", (numbers[number] for number in channels))
+            postings = {
+                numbers[channel]: tokens
+                for channel, tokens in postings.items()
+            }
+        segment.channels = channels
+        segment.postings = postings
+        for channel, length in zip(channels, segment.lengths):
+            stats = segment.stats.setdefault(channel, [0, 0])
+            stats[0] += 1
+            stats[1] += length
+        segment.newest = max(segment.times) if documents else 0.0
+        return segment
+
+
+class SearchIndex(object):
+    """Incremental inverted index of shiptoasts.
+
+    New shiptoasts go to a live segment, which is frozen on each save. When
+    there are more than SEARCH_SEGMENTS frozen segments, the smallest pair
+    of neighbours is merged. Segments are kept in order of their newest
+    shiptoast. Shiptoast ids are only unique per channel, so documents are
+    keyed by both.
+
+    When path is set it's a directory, holding each segment in a file of
+    its own and a manifest listing them. Saves only write segments new
+    since the last one. The first pod to save takes an flock on the
+    directory and is the only one to write to it while it runs.
+    """
+
+    def __init__(self, path=SEARCH_INDEX):
+        self.path = path
+        self._segments = []  # frozen segments, oldest first
+        self._live = Segment()
+        self._channel_names = []  # channel number: channel name
+        self._documents = {}  # channel name: set of shiptoast ids
+        self._lock = threading.RLock()
+        self._saving = threading.Lock()
+        self._writer = None  # lock file, held while we write to path
+        self._next = 1  # number of the next segment file
+        self.backfill = {}  # datastore kind: backfill progress
+        self.dirty = False
+
+    def __len__(self):
+        return sum(len(segment) for segment in self._all_segments())
+
+    def __contains__(self, key):
+        channel, _id = key
+        return _id in self._documents.get(channel, ())
+
+    def _all_segments(self):
+        """Returns the segments to search, oldest first."""
+
+        return self._segments + [self._live]
+
+    def add(self, shiptoast):
+        """Adds a shiptoast to the index, if it isn't already."""
+
+        with self._lock:
+            if shiptoast.id is None or \
+                    (shiptoast.channel, shiptoast.id) in self:
+                return
+            self._documents.setdefault(shiptoast.channel, set()).add(
+                shiptoast.id
+            )
+            self._live.add(shiptoast, self._channel_number(shiptoast.channel))
+            self.dirty = True
+
+    def add_segment(self, shiptoasts):
+        """Adds any new shiptoasts, in time order, as a frozen segment.
+
+        Returns:
+            the number of shiptoasts added
+        """
+
+        segment = Segment()
+        with self._lock:
+            for shiptoast in sorted(shiptoasts, key=lambda st: st.timestamp):
+                if shiptoast.id is None or \
+                        (shiptoast.channel, shiptoast.id) in self:
+                    continue
+                self._documents.setdefault(shiptoast.channel, set()).add(
+                    shiptoast.id
+                )
+                segment.add(shiptoast, self._channel_number(shiptoast.channel))
+
+            if len(segment):
+                self._insert(segment)
+                self.dirty = True
+
+        return len(segment)
+
+    def set_backfill(self, kind, progress):
+        """Records the backfill progress of a datastore kind."""
+
+        with self._lock:
+            self.backfill[kind] = progress
+            self.dirty = True
+
+    def _channel_number(self, channel):
+        """Returns the number of a channel name, numbering it if it's new."""
+
+        try:
+            return self._channel_names.index(channel)
+        except ValueError:
+            self._channel_names.append(channel)
+            return len(self._channel_names) - 1
+
+    def _insert(self, segment):
+        """Inserts a frozen segment in order. Call with self._lock."""
+
+        newest = [frozen.newest for frozen in self._segments]
+        position = bisect.bisect_right(newest, segment.newest)
+        # searches may still be walking the old list
+        self._segments = (self._segments[:position] + [segment] +
+                          self._segments[position:])
+
+    def freeze(self):
+        """Moves the live segment's documents to a new frozen segment."""
+
+        with self._lock:
+            if len(self._live):
+                self._insert(self._live)
+                self._live = Segment()
+
+    def compact(self):
+        """Merges neighbouring segments until there are SEARCH_SEGMENTS."""
+
+        while True:
+            with self._lock:
+                segments = self._segments
+                if len(segments) <= max(SEARCH_SEGMENTS, 1):
+                    return
+                position = min(
+                    range(len(segments) - 1),
+                    key=lambda i: len(segments[i]) + len(segments[i + 1]),
+                )
+                older, newer = segments[position:position + 2]
+
+            merged = Segment.merged(older, newer)
+
+            with self._lock:
+                self._segments = [
+                    segment for segment in self._segments
+                    if segment is not older and segment is not newer
+                ]
+                self._insert(merged)
+                self.dirty = True
+
+    def search(self, query, page=0, page_size=SEARCH_PAGE, channel=""):
+        """Finds the shiptoasts in channel matching every token in the query.
+
+        Segments are walked newest first, each along the channel's postings
+        of its rarest query token. The walk stops once there are
+        SEARCH_CANDIDATES matches (or enough for the page), or SEARCH_PROBES
+        of the channel's documents have been tried. The matches found are
+        ranked by BM25, with document frequencies taken from the channel.
+        Ties go to the most recent shiptoast. When the walk stops early, the
+        total is estimated from the share of tried documents that matched.
+
+        Returns:
+            tuple of (list of shiptoast ids for the page, total matches)
+        """
+
+        tokens = set(tokenize(query))
+        if not tokens or channel not in self._channel_names:
+            return [], 0
+        channel_number = self._channel_names.index(channel)
+
+        segments = self._all_segments()
+        total_documents = 0
+        total_length = 0
+        frequencies = dict.fromkeys(tokens, 0)
+        for segment in segments:
+            documents, length = segment.stats.get(channel_number, (0, 0))
+            total_documents += documents
+            total_length += length
+            postings = segment.postings.get(channel_number, {})
+            for token in tokens:
+                if token in postings:
+                    frequencies[token] += len(postings[token][0])
+        if not total_documents or not all(frequencies.values()):
+            return [], 0
+
+        weights = {
+            token: math.log(1 + (total_documents - frequency + 0.5) /
+                            (frequency + 0.5)) * (BM25_K1 + 1)
+            for token, frequency in frequencies.items()
+        }
+        average_length = total_length / total_documents or 1
+        base_norm = BM25_K1 * (1 - BM25_B)
+        length_norm = BM25_K1 * BM25_B / average_length
+        wanted = max(SEARCH_CANDIDATES, (page + 1) * page_size)
+
+        scored = []
+        probed = 0
+        unprobed = 0  # documents left on the walk when it stopped early
+        for segment in reversed(segments):
+            channel_postings = segment.postings.get(channel_number, {})
+            if not all(token in channel_postings for token in tokens):
+                continue
+            postings = sorted(
+                (channel_postings[token] + (weights[token],)
+                 for token in tokens),
+                key=lambda posting: len(posting[0]),
+            )
+            documents, term_frequencies, weight = postings[0]
+            others = postings[1:]
+            if len(scored) >= wanted or probed >= SEARCH_PROBES:
+                unprobed += len(documents)
+                continue
+
+            # walking down, each match can only be below the last
+            bounds = [len(other[0]) for other in others]
+            lengths = segment.lengths
+            position = len(documents)
+            while position:
+                if len(scored) >= wanted or probed >= SEARCH_PROBES:
+                    unprobed += position
+                    break
+                position -= 1
+                probed += 1
+                document = documents[position]
+                norm = base_norm + length_norm * lengths[document]
+                frequency = term_frequencies[position]
+                score = weight * frequency / (frequency + norm)
+                for number, other in enumerate(others):
+                    found = bisect.bisect_left(
+                        other[0],
+                        document,
+                        0,
+                        bounds[number],
+                    )
+                    bounds[number] = found
+                    if found == len(other[0]) or other[0][found] != document:
+                        break
+                    frequency = other[1][found]
+                    score += other[2] * frequency / (frequency + norm)
+                else:
+                    scored.append((
+                        score,
+                        segment.times[document],
+                        segment.ids[document],
+                    ))
+
+        total = len(scored)
+        if unprobed and probed:
+            total += int(unprobed * len(scored) / probed)
+
+        start = page * page_size
+        ranked = heapq.nlargest(start + page_size, scored)[start:]
+        return [_id for _, _, _id in ranked], total
+
+    def save(self):
+        """Freezes and compacts the index, then writes any new segments."""
+
+        with self._saving:
+            self.freeze()
+            self.compact()
+            if not self.path or not self.dirty or not self.take_writer():
+                return
+
+            with self._lock:
+                segments = self._segments
+                channel_names = list(self._channel_names)
+                backfill = dict(self.backfill)
+                self.dirty = False
+
+            try:
+                for segment in segments:
+                    if segment.name is None:
+                        name = "segment-{}.gz".format(self._next)
+                        segment.write(os.path.join(self.path, name),
+                                      channel_names)
+                        segment.name = name
+                        self._next += 1
+
+                manifest = os.path.join(self.path, MANIFEST)
+                temp_file = "{}.tmp".format(manifest)
+                with open(temp_file, "w") as openmanifest:
+                    json.dump({
+                        "segments": [segment.name for segment in segments],
+                        "next": self._next,
+                        "backfill": backfill,
+                    }, openmanifest)
+                os.replace(temp_file, manifest)
+            except OSError as error:
+                logging.warning("could not save search index %s: %r",
+                                self.path, error)
+                self.dirty = True
+                return
+
+            # merged away segments
+            names = set(segment.name for segment in segments)
+            for name in os.listdir(self.path):
+                if segment_pattern.match(name) and name not in names:
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+
+    def take_writer(self):
+        """Takes the directory's lock, if no other process holds it.
+
+        Returns:
+            boolean of if we're the writer
+        """
+
+        if self._writer is not None:
+            return True
+        if not self.path:
+            return False
+
+        try:
+            if os.path.isfile(self.path):
+                os.remove(self.path)  # written before segments, see load
+            os.makedirs(self.path, exist_ok=True)
+            lock_file = open(os.path.join(self.path, "lock"), "a")
+        except OSError as error:
+            logging.warning("could not save search index %s: %r",
+                            self.path, error)
+            return False
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False  # another pod on this node is writing
+
+        # the last writer may have merged away segments we loaded
+        manifest = _read_manifest(self.path) or {}
+        on_disk = set(manifest.get("segments", []))
+        with self._lock:
+            for segment in self._segments:
+                if segment.name not in on_disk:
+                    segment.name = None
+        self._next = max(self._next, manifest.get("next", 1))
+        self._writer = lock_file
+        return True
+
+    @classmethod
+    def load(cls, path=SEARCH_INDEX):
+        """Returns the index read from the directory, or an empty one.
+
+        A single segment file at path (as written before segments) is read
+        too, and replaced with a directory on the next save.
+        """
+
+        index = cls(path)
+        if not path or not os.path.exists(path):
+            return index
+
+        if os.path.isfile(path):
+            manifest = {"segments": [None]}
+        else:
+            manifest = _read_manifest(path)
+            if manifest is None:
+                return index
+
+        segments = []
+        try:
+            for name in manifest["segments"]:
+                if name is None:
+                    segment = Segment.read(path, index._channel_number)
+                else:
+                    segment = Segment.read(os.path.join(path, name),
+                                           index._channel_number)
+                segment.name = name
+                segments.append(segment)
+        except (OSError, ValueError, KeyError, EOFError) as error:
+            logging.warning("could not load search index %s: %r", path, error)
+            return cls(path)
+
+        for segment in segments:
+            for channel_number, _id in zip(segment.channels, segment.ids):
+                index._documents.setdefault(
+                    index._channel_names[channel_number],
+                    set(),
+                ).add(_id)
+            index._insert(segment)
+
+        index.backfill = manifest.get("backfill", {})
+        index._next = manifest.get("next", 1)
+        index.dirty = any(segment.name is None for segment in segments)
+        return index
+
+
+def _read_manifest(path):
+    """Returns the manifest in the index directory at path, or None."""
+
+    try:
+        with open(os.path.join(path, MANIFEST)) as openmanifest:
+            return json.load(openmanifest)
+    except (OSError, ValueError) as error:
+        if not isinstance(error, FileNotFoundError):
+            logging.warning("could not read search index manifest %s: %r",
+                            path, error)
+        return None
+
+
+Document = namedtuple(
+    "Document",
+    ("author", "author_id", "content", "id", "channel", "timestamp"),
+)
+
+
+def synthetic_documents(count, seed=0, vocabulary=10000, authors=1000):
+    """Yields count shiptoasts of random words, one second apart.
+
+    Words are w0, w1, ... drawn with zipfian frequencies. Authors are named
+    "pilot <n>". Four out of five are in the default channel.
+    """
+
+    rng = random.Random(seed)
+    words = ["w{}".format(rank) for rank in range(vocabulary)]
+    weights = list(itertools.accumulate(
+        1 / (rank + 1) for rank in range(vocabulary)
+    ))
+    started = time.time() - count
+    for number in range(count):
+        author = rng.randrange(authors)
+        yield Document(
+            "pilot {}".format(author),
+            author,
+            " ".join(
+                words[bisect.bisect(weights, rng.random() * weights[-1])]
+                for _ in range(rng.randint(4, 20))
+            ),
+            number + 1,
+            "" if rng.random() < 0.8 else "c{}".format(rng.randrange(5)),
+            started + number,
+        )
+
+
+def _timed(function, *args, **kwargs):
+    """Returns a tuple of (milliseconds taken, return value)."""
+
+    started = time.perf_counter()
+    returned = function(*args, **kwargs)
+    return (time.perf_counter() - started) * 1000, returned
+
+
+def main(argv=None):
+    """Command line entry point, prints a benchmark report as JSON.
+
+    The index is built from synthetic shiptoasts, saving every so many as a
+    pod would, then each query is timed on the first and a later page.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Benchmarks building, saving and searching the index.",
+    )
+    parser.add_argument(
+        "--documents",
+        type=int, default=1000000,
+        help="number of synthetic shiptoasts to index",
+    )
+    parser.add_argument(
+        "--save-every",
+        type=int, default=20000,
+        help="shiptoasts indexed between each save",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int, default=5,
+        help="times each query is run, the median time is reported",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int, default=0,
+        help="seed for the synthetic shiptoasts",
+    )
+    parser.add_argument(
+        "--persist",
+        action="store_true",
+        help="save to a temporary directory, and time loading it back",
+    )
+    parser.add_argument(
+        "queries",
+        nargs="*",
+        default=["w0", "w0 w1", "pilot", "w5 w50", "w9999", "w3 w4 w5"],
+        help="queries to time",
+    )
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp() if args.persist else None
+    path = os.path.join(directory, "index") if directory else None
+    index = SearchIndex(path)
+    report = OrderedDict()
+
+    save_times = []
+    started = time.perf_counter()
+    for number, document in enumerate(synthetic_documents(
+            args.documents, args.seed)):
+        index.add(document)
+        if not (number + 1) % args.save_every:
+            save_times.append(_timed(index.save)[0])
+    save_times.append(_timed(index.save)[0])
+    report["index_seconds"] = time.perf_counter() - started
+    report["segments"] = len(index._segments)
+    save_times.sort()
+    report["save_ms"] = OrderedDict([
+        ("p50", save_times[len(save_times) // 2]),
+        ("max", save_times[-1]),
+    ])
+
+    if path:
+        load_ms, _ = _timed(SearchIndex.load, path)
+        report["load_ms"] = load_ms
+
+    report["queries"] = OrderedDict()
+    for query in args.queries:
+        timings = OrderedDict()
+        for page in (0, 3):
+            runs = sorted(
+                _timed(index.search, query, page)
+                for _ in range(args.repeat)
+            )
+            milliseconds, (ids, total) = runs[len(runs) // 2]
+            timings["page_{}_ms".format(page)] = milliseconds
+            timings["total"] = total
+        report["queries"][query] = timings
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,764 @@
+"""Deterministic in-process simulation of a cluster of shiptoasting pods.
+
+The datastore, pubsub and kube APIs are faked closely enough for the real
+ShipToasts to run against them, with every pod in one process sharing a
+virtual clock. Runs with the same arguments and seed behave the same.
+"""
+
+
+import json
+import heapq
+import random
+import operator
+import argparse
+import itertools
+from time import perf_counter
+from collections import OrderedDict
+
+from gcloud import datastore
+from gcloud.exceptions import Conflict
+from gcloud.exceptions import NotFound
+
+from shiptoasting.storage import ShipToasts
+
+
+EPOCH = 1460937600.0  # virtual time zero, the monday after fanfest 2016
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    "=": operator.eq,
+    ">=": operator.ge,
+    ">": operator.gt,
+}
+
+
+class Clock(object):
+    """Virtual clock and the queue of events scheduled on it.
+
+    Events at the same time run in the order they were scheduled.
+    """
+
+    def __init__(self, start=EPOCH):
+        self.now = start
+        self._events = []
+        self._order = itertools.count()
+
+    def __call__(self):
+        return self.now
+
+    def schedule(self, delay, callback, *args):
+        """Runs callback(*args) after delay virtual seconds."""
+
+        heapq.heappush(
+            self._events,
+            (self.now + delay, next(self._order), callback, args),
+        )
+
+    def run_until(self, end):
+        """Runs every event scheduled up to end, then moves the clock to it."""
+
+        while self._events and self._events[0][0] <= end:
+            when, _, callback, args = heapq.heappop(self._events)
+            self.now = when
+            callback(*args)
+        self.now = max(self.now, end)
+
+
+class FakeDatastore(object):
+    """Datastore client fake, shared by every pod.
+
+    Lookups by key are strongly consistent, queries only see an entity
+    query_lag seconds after it was put, like the real (eventually
+    consistent) indexes.
+    """
+
+    def __init__(self, clock, query_lag=0, project="simulation"):
+        self.clock = clock
+        self.query_lag = query_lag
+        self.project = project
+        self._entities = {}  # key: (visible to queries at, entity)
+        self._ids = itertools.count(1)
+        self.puts = 0
+        self.lookups = 0
+        self.queries = 0
+
+    def key(self, *path_args):
+        """Returns a (real) datastore key in our project."""
+
+        return datastore.Key(*path_args, project=self.project)
+
+    def put(self, entity):
+        """Stores a copy of the entity, completing its key if partial."""
+
+        if entity.key.is_partial:
+            entity.key = entity.key.completed_key(next(self._ids))
+
+        stored = datastore.Entity(entity.key)
+        stored.update(entity)
+        self._entities[entity.key] = (self.clock() + self.query_lag, stored)
+        self.puts += 1
+
+    def get(self, key):
+        """Returns the entity stored at key, or None."""
+
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys):
+        """Returns the entities stored at any of the keys."""
+
+        self.lookups += len(keys)
+        return [
+            self._entities[key][1] for key in keys if key in self._entities
+        ]
+
+    def query(self, kind, order=(), filters=()):
+        """Returns a query on the kind, see FakeQuery."""
+
+        return FakeQuery(self, kind, order, filters)
+
+    def _visible(self, kind):
+        """Returns the entities of kind that queries can see, in put order.
+
+        The __kind__ metadata kind has an entity named for each kind stored.
+        """
+
+        self.queries += 1
+        now = self.clock()
+        if kind == "__kind__":
+            kinds = sorted(set(
+                entity.key.kind for _, entity in self._entities.values()
+            ))
+            return [datastore.Entity(self.key(kind, name)) for name in kinds]
+
+        return [
+            entity for visible, entity in self._entities.values()
+            if entity.key.kind == kind and visible <= now
+        ]
+
+
+class FakeQuery(object):
+    """Datastore query fake, supports property filters and sort orders."""
+
+    def __init__(self, client, kind, order, filters):
+        self.client = client
+        self.kind = kind
+        self.order = list(order)
+        self.filters = list(filters)
+        self._keys_only = False
+
+    def keys_only(self):
+        """Only return the keys of matching entities."""
+
+        self._keys_only = True
+
+    def fetch(self, limit=None, start_cursor=None):
+        """Runs the query, returns a FakeIterator over the results."""
+
+        entities = self.client._visible(self.kind)
+        for prop, op, value in self.filters:
+            compare = OPERATORS[op]
+            entities = [ent for ent in entities if compare(ent[prop], value)]
+
+        for prop in reversed(self.order):
+            entities.sort(
+                key=operator.itemgetter(prop.lstrip("-")),
+                reverse=prop.startswith("-"),
+            )
+
+        if self._keys_only:
+            entities = [datastore.Entity(entity.key) for entity in entities]
+
+        return FakeIterator(entities, limit, start_cursor)
+
+
+class FakeIterator(object):
+    """Query results iterator fake. Cursors are offsets into the results."""
+
+    def __init__(self, entities, limit, start_cursor):
+        offset = int(start_cursor or 0)
+        end = len(entities) if limit is None else offset + limit
+        self._page = entities[offset:end]
+        self._more = end < len(entities)
+        self._cursor = str(end).encode("ascii")
+
+    def __iter__(self):
+        return iter(self._page)
+
+    def next_page(self):
+        """Returns a tuple of (entities, more results, next cursor)."""
+
+        return self._page, self._more, self._cursor
+
+
+class FakeMessage(object):
+    """Pubsub message fake."""
+
+    def __init__(self, message_id, data):
+        self.message_id = message_id
+        self.data = data
+
+
+class FakePubsub(object):
+    """Pubsub client fake, shared by every pod.
+
+    Each message published is delivered to every subscription on its topic
+    after latency plus up to jitter seconds, unless it's lost. Deliveries
+    may also be duplicated. Unacknowledged messages are not redelivered.
+    on_delivery is called with the subscription name as messages arrive.
+    """
+
+    def __init__(self, clock, rng, latency=0.05, jitter=0.1, loss=0,
+                 duplicate=0, on_delivery=None):
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.on_delivery = on_delivery
+        self._topics = OrderedDict()  # topic name: list of subscription names
+        self._queues = {}  # subscription name: list of (ack_id, message)
+        self._ids = itertools.count(1)
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def topic(self, name):
+        """Returns a handle on the named topic, which may not exist."""
+
+        return FakeTopic(self, name)
+
+    def list_topics(self, page_size=None, page_token=None):
+        """Returns a tuple of (list of topics, next page token or None)."""
+
+        names = sorted(self._topics)
+        start = int(page_token or 0)
+        end = len(names) if page_size is None else start + page_size
+        topics = [FakeTopic(self, name) for name in names[start:end]]
+        return topics, str(end) if end < len(names) else None
+
+    def _publish(self, topic_name, data):
+        """Schedules the deliveries of a message to the topic's subs."""
+
+        message = FakeMessage(str(next(self._ids)), data)
+        self.published += 1
+        for sub_name in self._topics[topic_name]:
+            if self.rng.random() < self.loss:
+                self.dropped += 1
+                continue
+            copies = 2 if self.rng.random() < self.duplicate else 1
+            for _ in range(copies):
+                self.clock.schedule(
+                    self.latency + self.rng.random() * self.jitter,
+                    self._deliver,
+                    sub_name,
+                    message,
+                )
+        return message.message_id
+
+    def _deliver(self, sub_name, message):
+        """Queues a message on a subscription, if it still exists."""
+
+        if sub_name not in self._queues:
+            self.dropped += 1
+            return
+
+        ack_id = "{}-{}".format(sub_name, next(self._ids))
+        self._queues[sub_name].append((ack_id, message))
+        self.delivered += 1
+        if self.on_delivery is not None:
+            self.on_delivery(sub_name)
+
+
+class FakeTopic(object):
+    """Pubsub topic handle fake."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def exists(self):
+        """Returns a boolean of if the topic exists."""
+
+        return self.name in self.client._topics
+
+    def create(self):
+        """Creates the topic, raises Conflict if it already exists."""
+
+        if self.exists():
+            raise Conflict("topic {} exists".format(self.name))
+        self.client._topics[self.name] = []
+
+    def delete(self):
+        """Deletes the topic, its subscriptions stop receiving messages."""
+
+        if not self.exists():
+            raise NotFound("topic {} not found".format(self.name))
+        del self.client._topics[self.name]
+
+    def publish(self, message):
+        """Publishes the message bytes, returns the message id."""
+
+        if not self.exists():
+            raise NotFound("topic {} not found".format(self.name))
+        return self.client._publish(self.name, message)
+
+    def subscription(self, name):
+        """Returns a handle on a subscription to this topic."""
+
+        return FakeSubscription(self.client, name, self.name)
+
+    def list_subscriptions(self, page_size=None, page_token=None):
+        """Returns a tuple of (list of subscriptions, None)."""
+
+        if not self.exists():
+            raise NotFound("topic {} not found".format(self.name))
+        return [
+            self.subscription(name) for name in self.client._topics[self.name]
+        ], None
+
+
+class FakeSubscription(object):
+    """Pubsub pull subscription handle fake."""
+
+    def __init__(self, client, name, topic_name):
+        self.client = client
+        self.name = name
+        self.topic_name = topic_name
+
+    def exists(self):
+        """Returns a boolean of if the subscription exists."""
+
+        return self.name in self.client._queues
+
+    def create(self):
+        """Creates the subscription, it only sees messages published after."""
+
+        if self.exists():
+            raise Conflict("subscription {} exists".format(self.name))
+        if self.topic_name not in self.client._topics:
+            raise NotFound("topic {} not found".format(self.topic_name))
+        self.client._queues[self.name] = []
+        self.client._topics[self.topic_name].append(self.name)
+
+    def delete(self):
+        """Deletes the subscription and any messages waiting on it."""
+
+        if not self.exists():
+            raise NotFound("subscription {} not found".format(self.name))
+        del self.client._queues[self.name]
+        subscriptions = self.client._topics.get(self.topic_name, [])
+        if self.name in subscriptions:
+            subscriptions.remove(self.name)
+
+    def pull(self, return_immediately=False, max_messages=1):
+        """Returns a list of (ack_id, message) already delivered.
+
+        Never blocks, an empty list is returned if nothing is waiting.
+        """
+
+        if not self.exists():
+            raise NotFound("subscription {} not found".format(self.name))
+        queue = self.client._queues[self.name]
+        pulled, queue[:max_messages] = queue[:max_messages], []
+        return pulled
+
+    def acknowledge(self, ack_ids):
+        """Acknowledges messages, which are never redelivered anyway."""
+
+        if not self.exists():
+            raise NotFound("subscription {} not found".format(self.name))
+
+
+class FakeKube(object):
+    """Kube API fake, lists the names of the running pods."""
+
+    def __init__(self):
+        self.pods = []
+        self.available = True
+
+    def active_pods(self):
+        """Returns the running pods, or None if the API is unavailable."""
+
+        if not self.available:
+            return None
+        return list(self.pods)
+
+
+class SimulatedPod(object):
+    """A real ShipToasts running against the fakes, and what it was sent.
+
+    Subscribes to its own ShipToasts like a stream client would, recording
+    the virtual time of every notification for each shiptoast.
+    """
+
+    def __init__(self, simulation, name):
+        self.name = name
+        self.clock = simulation.clock
+        self.shiptoasts = ShipToasts(
+            name=name,
+            datastore_client=simulation.datastore,
+            pubsub_client=simulation.pubsub,
+            active_pods=simulation.kube.active_pods,
+            clock=simulation.clock,
+        )
+        self.started = self.clock.now
+        self.stopped = None
+        self.sub = None
+        self.received = {}  # content: list of notification times
+
+    @property
+    def running(self):
+        """Boolean of if the pod hasn't been stopped."""
+
+        return self.stopped is None
+
+    def start(self):
+        """Subscribes to updates, connects and fills the cache."""
+
+        self.shiptoasts.add_sub(self)
+        self.shiptoasts.connect()
+        self.shiptoasts.initial_fill()
+
+    def listen(self):
+        """Creates our pull subscription, then pulls anything waiting."""
+
+        if self.running:
+            self.sub = self.shiptoasts.subscribe()
+            self.pull()
+
+    def pull(self):
+        """Pulls until our subscription is empty."""
+
+        if self.running and self.sub is not None:
+            while self.shiptoasts.pull_updates(self.sub):
+                pass
+
+    def periodic_call(self, interval):
+        """Runs the ShipToasts periodic call, then schedules the next."""
+
+        if self.running:
+            self.shiptoasts.periodic_call()
+            self.clock.schedule(interval, self.periodic_call, interval)
+
+    def notify(self, shiptoast):
+        """Notify method to record cached events."""
+
+        self.received.setdefault(shiptoast.content, []).append(
+            self.clock.now
+        )
+
+
+class Simulation(object):
+    """N pods behind the fake APIs, posting and propagating shiptoasts.
+
+    Args:
+        pods: number of pods running at any time
+        rate: average shiptoasts posted per second, to random pods
+        latency: minimum pubsub delivery time
+        jitter: maximum extra pubsub delivery time
+        loss: probability of a pubsub delivery being lost
+        duplicate: probability of a pubsub delivery happening twice
+        query_lag: seconds before datastore queries see new entities
+        churn: seconds between replacing a random pod, 0 for never
+        startup: seconds between a pod connecting and subscribing
+        interval: seconds between each pod's periodic calls
+        authors: number of authors posting, 0 for a new one for every post
+        seed: random seed, runs with the same arguments are identical
+    """
+
+    def __init__(self, pods=3, rate=1.0, latency=0.05, jitter=0.1, loss=0,
+                 duplicate=0, query_lag=1.0, churn=0, startup=2.0,
+                 interval=30.0, authors=0, seed=0):
+        self.pod_count = pods
+        self.rate = rate
+        self.authors = authors
+        self.churn = churn
+        self.startup = startup
+        self.interval = interval
+        self.rng = random.Random(seed)
+        self.clock = Clock()
+        self.datastore = FakeDatastore(self.clock, query_lag)
+        self.pubsub = FakePubsub(
+            self.clock,
+            self.rng,
+            latency=latency,
+            jitter=jitter,
+            loss=loss,
+            duplicate=duplicate,
+            on_delivery=self._on_delivery,
+        )
+        self.kube = FakeKube()
+        self.pods = OrderedDict()  # pod name: SimulatedPod, stopped included
+        self.posts = OrderedDict()  # content: virtual time posted
+        self.rejected = 0
+        self._names = itertools.count(1)
+        self._numbers = itertools.count(1)
+
+    def running_pods(self):
+        """Returns the pods that haven't been stopped."""
+
+        return [pod for pod in self.pods.values() if pod.running]
+
+    def start_pod(self):
+        """Starts a new pod, it subscribes to pubsub after startup seconds."""
+
+        name = "shiptoasting-sim-{}".format(next(self._names))
+        self.kube.pods.append(name)
+        pod = SimulatedPod(self, name)
+        self.pods[name] = pod
+        pod.start()
+        self.clock.schedule(self.startup, pod.listen)
+        self.clock.schedule(
+            self.rng.random() * self.interval,
+            pod.periodic_call,
+            self.interval,
+        )
+        return pod
+
+    def stop_pod(self, pod):
+        """Stops a pod. Its topic is left for the others to clean up."""
+
+        pod.stopped = self.clock.now
+        self.kube.pods.remove(pod.name)
+
+    def _on_delivery(self, sub_name):
+        """Has the pod behind a subscription pull what was delivered."""
+
+        pod = self.pods.get(sub_name)
+        if pod is not None:
+            pod.pull()
+
+    def _post(self, until):
+        """Posts a shiptoast to a random pod, schedules the next post."""
+
+        number = next(self._numbers)
+        if self.authors:
+            author_id = self.rng.randrange(self.authors) + 1
+        else:
+            author_id = number
+        content = "simulated shiptoast #{}".format(number)
+        pod = self.rng.choice(self.running_pods())
+        self.posts[content] = self.clock.now
+        posted = pod.shiptoasts.add_shiptoast(
+            content,
+            "Simulated Toaster {}".format(author_id),
+            author_id,
+        )
+        if author_id not in posted:
+            self.rejected += 1
+            del self.posts[content]
+
+        delay = self.rng.expovariate(self.rate)
+        if self.clock.now + delay < until:
+            self.clock.schedule(delay, self._post, until)
+
+    def _replace_pod(self, until):
+        """Stops a random pod and starts another, schedules the next."""
+
+        self.stop_pod(self.rng.choice(self.running_pods()))
+        self.start_pod()
+        if self.clock.now + self.churn < until:
+            self.clock.schedule(self.churn, self._replace_pod, until)
+
+    def run(self, duration, drain=None):
+        """Posts for duration seconds, then lets delivery catch up.
+
+        Args:
+            duration: virtual seconds to post (and churn pods) for
+            drain: virtual seconds to run on for after, by default long
+                   enough for every pod to reconcile twice
+
+        Returns:
+            the report, see report()
+        """
+
+        if drain is None:
+            drain = 2 * self.interval + self.datastore.query_lag
+
+        started = perf_counter()
+        if not self.pods:
+            for _ in range(self.pod_count):
+                self.start_pod()
+
+        end = self.clock.now + duration
+        if self.rate > 0:
+            self.clock.schedule(
+                self.rng.expovariate(self.rate),
+                self._post,
+                end,
+            )
+        if self.churn > 0:
+            self.clock.schedule(self.churn, self._replace_pod, end)
+
+        self.clock.run_until(end + drain)
+        return self.report(perf_counter() - started)
+
+    def report(self, wall_seconds=None):
+        """Tallies deliveries of every post to every pod that should have it.
+
+        Posts are expected at the pods which were running when the post was
+        made and are still running now.
+
+        Returns:
+            ordered dictionary of measurements
+        """
+
+        latencies = []
+        expected = 0
+        missed = 0
+        for content, posted in self.posts.items():
+            for pod in self.running_pods():
+                if pod.started > posted:
+                    continue
+                expected += 1
+                received = pod.received.get(content)
+                if received:
+                    latencies.append(received[0] - posted)
+                else:
+                    missed += 1
+
+        duplicates = sum(
+            len(received) - 1
+            for pod in self.pods.values()
+            for received in pod.received.values()
+        )
+
+        latencies.sort()
+        report = OrderedDict([
+            ("posts", len(self.posts)),
+            ("rejected", self.rejected),
+            ("pods_started", len(self.pods)),
+            ("expected", expected),
+            ("delivered", len(latencies)),
+            ("missed", missed),
+            ("duplicates", duplicates),
+            ("latency", OrderedDict([
+                ("mean", sum(latencies) / len(latencies) if latencies else 0),
+                ("p50", _percentile(latencies, 0.5)),
+                ("p95", _percentile(latencies, 0.95)),
+                ("p99", _percentile(latencies, 0.99)),
+                ("max", latencies[-1] if latencies else 0),
+            ])),
+            ("pubsub", OrderedDict([
+                ("published", self.pubsub.published),
+                ("delivered", self.pubsub.delivered),
+                ("dropped", self.pubsub.dropped),
+                ("topics", len(self.pubsub._topics)),
+            ])),
+            ("datastore", OrderedDict([
+                ("puts", self.datastore.puts),
+                ("lookups", self.datastore.lookups),
+                ("queries", self.datastore.queries),
+            ])),
+        ])
+        if wall_seconds is not None:
+            report["wall_seconds"] = wall_seconds
+        return report
+
+
+def _percentile(ordered, fraction):
+    """Returns the value at fraction through the sorted list, or 0."""
+
+    if not ordered:
+        return 0
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def main(argv=None):
+    """Command line entry point, prints the report as JSON."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--duration",
+        type=float, default=300,
+        help="virtual seconds to post for",
+    )
+    parser.add_argument(
+        "--drain",
+        type=float, default=None,
+        help="virtual seconds to run on for after posting",
+    )
+    parser.add_argument(
+        "--pods",
+        type=int, default=3,
+        help="number of pods running",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float, default=1.0,
+        help="shiptoasts posted per second",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float, default=0.05,
+        help="minimum pubsub delivery seconds",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float, default=0.1,
+        help="maximum extra pubsub delivery seconds",
+    )
+    parser.add_argument(
+        "--loss",
+        type=float, default=0,
+        help="probability of losing a pubsub delivery",
+    )
+    parser.add_argument(
+        "--duplicate",
+        type=float, default=0,
+        help="probability of a duplicate pubsub delivery",
+    )
+    parser.add_argument(
+        "--query-lag",
+        type=float, default=1.0,
+        help="seconds before queries see new entities",
+    )
+    parser.add_argument(
+        "--churn",
+        type=float, default=0,
+        help="seconds between replacing a pod, 0 for never",
+    )
+    parser.add_argument(
+        "--startup",
+        type=float, default=2.0,
+        help="seconds from a pod connecting to subscribing",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float, default=30.0,
+        help="seconds between periodic calls",
+    )
+    parser.add_argument(
+        "--authors",
+        type=int, default=0,
+        help="number of authors posting, 0 for a new one for every post",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int, default=0,
+        help="random seed",
+    )
+    args = parser.parse_args(argv)
+
+    simulation = Simulation(
+        pods=args.pods,
+        rate=args.rate,
+        latency=args.latency,
+        jitter=args.jitter,
+        loss=args.loss,
+        duplicate=args.duplicate,
+        query_lag=args.query_lag,
+        churn=args.churn,
+        startup=args.startup,
+        interval=args.interval,
+        authors=args.authors,
+        seed=args.seed,
+    )
+    report = simulation.run(args.duration, args.drain)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
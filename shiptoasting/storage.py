@@ -2,12 +2,17 @@
 
 
 import os
+import re
+import gzip
 import html
+import json
 import time
 import yaml
+import asyncio
 import logging
 import datetime
-from collections import namedtuple
+import threading
+from collections import OrderedDict
 
 from bs4 import BeautifulSoup
 from flask import abort
@@ -18,15 +23,103 @@ from gcloud.exceptions import NotFound
 
 from shiptoasting import app
 from shiptoasting import HEARTBEAT
+from shiptoasting.embeds import EmbedCache
+from shiptoasting.embeds import EmbedResolver
+from shiptoasting.formatting import apply_embeds
 from shiptoasting.formatting import format_message
 from shiptoasting.kube import all_active_pods
+from shiptoasting.ratelimit import RATE_WINDOW
+from shiptoasting.ratelimit import RateLimiter
+from shiptoasting.search import SearchIndex
 
 
 VISIBLE_POSTS = int(os.environ.get("SHIPTOASTS_VISIBLE_MAX", 50))
 SPAM_ALLOWED = bool(int(os.environ.get("SPAM_IS_ALLOWED", 0)))
 KIND = os.environ.get("DATASTORE_KIND", "shiptoast")
-ShipToast = namedtuple("ShipToast",
-                       ("author", "author_id", "content", "time", "id"))
+SNAPSHOT = os.environ.get("SHIPTOASTS_SNAPSHOT")
+RECONCILE_LAG = int(os.environ.get("SHIPTOASTS_RECONCILE_LAG", 60))
+HISTORY_PAGE = int(os.environ.get("SHIPTOASTS_HISTORY_PAGE", 25))
+HISTORY_CACHE = int(os.environ.get("SHIPTOASTS_HISTORY_CACHE", 256))
+CHANNELS_MAX = int(os.environ.get("SHIPTOASTS_CHANNELS_MAX", 100))
+WARM_START_RETRY = int(os.environ.get("SHIPTOASTS_WARM_START_RETRY", 5))
+WARM_START_RETRY_MAX = 300
+BACKFILL = bool(int(os.environ.get("SHIPTOASTS_SEARCH_BACKFILL", 1)))
+BACKFILL_PAGE = int(os.environ.get("SHIPTOASTS_SEARCH_BACKFILL_PAGE", 500))
+BACKFILL_PAUSE = float(os.environ.get("SHIPTOASTS_SEARCH_BACKFILL_PAUSE", 1))
+AVATAR_URL = "https://image.eveonline.com/Character/{}_256.jpg"
+DEFAULT_CHANNEL = ""
+
+channel_pattern = re.compile("^[a-z0-9][a-z0-9_-]{0,31}$")
+
+
+def _epoch(posted):
+    """Returns the timestamp of a datetime, naive datetimes are UTC."""
+
+    if posted.tzinfo is None:
+        posted = posted.replace(tzinfo=datetime.timezone.utc)
+    return posted.timestamp()
+
+
+def normalize_channel(channel):
+    """Returns the lower cased channel name, raises ValueError if invalid."""
+
+    channel = (channel or DEFAULT_CHANNEL).strip().lower()
+    if channel and not channel_pattern.match(channel):
+        raise ValueError("invalid channel name: {!r}".format(channel))
+    return channel
+
+
+def channel_kind(channel):
+    """Returns the datastore kind the channel's shiptoasts are stored as."""
+
+    if channel == DEFAULT_CHANNEL:
+        return KIND
+    return "{}-{}".format(KIND, channel)
+
+
+def kind_channel(kind):
+    """Returns the channel stored as a datastore kind (see channel_kind)."""
+
+    if kind == KIND:
+        return DEFAULT_CHANNEL
+    return kind[len(KIND) + 1:]
+
+
+class ShipToast(object):
+    """A shiptoast, with everything needed for display computed once."""
+
+    __slots__ = ("author", "author_id", "content", "time", "id", "channel",
+                 "timestamp", "display_time", "is_ccp")
+    _fields = ("author", "author_id", "content", "time", "id", "channel")
+
+    def __init__(self, author, author_id, content, posted, _id,
+                 channel=DEFAULT_CHANNEL):
+        self.author = author
+        self.author_id = author_id
+        self.content = content
+        self.time = posted
+        self.id = _id
+        self.channel = channel
+        self.timestamp = _epoch(posted)
+        self.display_time = posted.strftime("%b %e, %H:%M:%S")
+        self.is_ccp = author.startswith("CCP ")
+
+    @property
+    def avatar(self):
+        """Returns the author's portrait url."""
+
+        return AVATAR_URL.format(self.author_id)
+
+    def __repr__(self):
+        return "ShipToast({})".format(", ".join(
+            "{}={!r}".format(field, getattr(self, field))
+            for field in self._fields
+        ))
+
+    def _asdict(self):
+        """Returns the stored (not derived) fields as a dictionary."""
+
+        return {field: getattr(self, field) for field in self._fields}
 
 
 def _clean_content(message):
@@ -43,116 +136,457 @@ def _clean_content(message):
         abort(400)
 
 
+def _from_entity(entity):
+    """Returns a formatted ShipToast from a datastore entity."""
+
+    return ShipToast(
+        entity["author"],
+        entity["author_id"],
+        format_message(entity["content"]),
+        entity["time"],
+        entity.key.id,
+        kind_channel(entity.key.kind),
+    )
+
+
+class _MessageLoader(yaml.SafeLoader):
+    """Safe YAML loader for the shiptoasts published between pods.
+
+    Pods on python 3.5 publish namedtuple._asdict(), an OrderedDict, which
+    the plain safe loader refuses to construct. It's read as a dict here.
+    """
+
+
+def _construct_ordered_dict(loader, node):
+    """Returns a dict from the YAML of a pickled OrderedDict."""
+
+    if isinstance(node, yaml.MappingNode):
+        args = loader.construct_mapping(node, deep=True).get("args", [])
+    else:
+        args = loader.construct_sequence(node, deep=True)
+    return dict(*args)
+
+
+_MessageLoader.add_constructor(
+    "tag:yaml.org,2002:python/object/apply:collections.OrderedDict",
+    _construct_ordered_dict,
+)
+
+
+def _from_message(data):
+    """Returns a formatted ShipToast from a pubsub message's data."""
+
+    message = yaml.load(data, Loader=_MessageLoader)
+    return ShipToast(
+        message["author"],
+        message["author_id"],
+        format_message(message["content"]),
+        message["time"],
+        message["id"],
+        message.get("channel", DEFAULT_CHANNEL),
+    )
+
+
 def _time_sorted(shiptoast_list):
     """Sorts a list of shiptoasts by time posted."""
 
-    return sorted(shiptoast_list, key=lambda k: k.time)
+    return sorted(shiptoast_list, key=lambda k: k.timestamp)
 
 
 class ShipToastCache(list):
     """In-memory cache of shiptoasts seen by this pod."""
 
-    def is_spam(self, shiptoast):
-        """Returns a boolean of if the post is considered spam."""
+    def is_repeat(self, shiptoast):
+        """Returns a boolean of if the author just posted the same content."""
 
-        if SPAM_ALLOWED:
-            return False
-
-        # can't compare offset-naive and offset-aware datetimes
-        # this error is the worst. completely avoidable, maybe worth a warning
-        cutoff = shiptoast.time - datetime.timedelta(seconds=30)
-        if cutoff.tzname():
-            cutoff_naive = datetime.datetime.fromtimestamp(cutoff.timestamp())
-        else:
-            cutoff_naive = cutoff
-            cutoff = datetime.datetime.fromtimestamp(
-                cutoff_naive.timestamp(),
-                tz=datetime.timezone.utc,
-            )
-
-        shiptoasted = 0
+        cutoff = shiptoast.timestamp - RATE_WINDOW
         for known in self:
-            try:
-                inside_cutoff = known.time > cutoff
-            except TypeError:
-                inside_cutoff = known.time > cutoff_naive
-
-            if inside_cutoff:
-                if known.author_id == shiptoast.author_id:
-                    if known.content == shiptoast.content:
-                        return True
-                    shiptoasted += 1
-                if shiptoasted >= 2:
-                    return True
-            else:
+            if known.timestamp <= cutoff:
                 break
+            if known.author_id == shiptoast.author_id and \
+                    known.content == shiptoast.content:
+                return True
 
         return False
 
     def inject(self, shiptoast):
-        """Add a shiptoast to the front of the cache, trims the end."""
+        """Add a shiptoast to the cache in time order, trims the end.
 
-        self.insert(0, shiptoast)
+        Returns:
+            boolean of if the shiptoast is still cached after trimming
+        """
+
+        index = 0
+        while index < len(self) and \
+                self[index].timestamp > shiptoast.timestamp:
+            index += 1
+
+        self.insert(index, shiptoast)
         while len(self) > VISIBLE_POSTS:
             self.pop(-1)
 
+        return index < VISIBLE_POSTS
+
+
+class PageCache(OrderedDict):
+    """Bounded LRU of history pages served by this pod."""
+
+    def __init__(self, max_pages=HISTORY_CACHE):
+        super(PageCache, self).__init__()
+        self.max_pages = max_pages
+
+    def get(self, key, default=None):
+        """Returns the cached page for key, marking it as recently used."""
+
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, page):
+        """Caches a page, dropping the least recently used if full."""
+
+        self[key] = page
+        self.move_to_end(key)
+        while len(self) > self.max_pages:
+            self.popitem(last=False)
+
+
+class Channel(object):
+    """Cache, subscribers and reconcile cursor of a single channel."""
+
+    def __init__(self, name):
+        self.name = name
+        self.kind = channel_kind(name)
+        self.cache = ShipToastCache()
+        self.subs = []  # instances subscribed to changes in this channel
+        self.cursor = None  # timestamp of the newest shiptoast seen, or
+        #   of when the channel was filled if it was empty
+        self.seen = {}  # id: timestamp of shiptoasts in the reconcile window
+
+
+class ChannelCache(OrderedDict):
+    """Bounded LRU of the channels cached by this pod.
+
+    The default channel, and any channel with subscribers, is never evicted.
+    """
+
+    def __init__(self, max_channels=CHANNELS_MAX):
+        super(ChannelCache, self).__init__()
+        self.max_channels = max_channels
+
+    def peek(self, name):
+        """Returns the channel if it's cached, without marking it as used."""
+
+        return super(ChannelCache, self).get(name)
+
+    def allocate(self, name):
+        """Returns the channel, creating it (and evicting others) if needed.
+
+        Returns:
+            tuple of (Channel, boolean of if it was just created)
+        """
+
+        if name in self:
+            self.move_to_end(name)
+            return self[name], False
+
+        self[name] = channel = Channel(name)
+        for evictable in list(self):
+            if len(self) <= self.max_channels:
+                break
+            if evictable != DEFAULT_CHANNEL and evictable != name and \
+                    not self[evictable].subs:
+                del self[evictable]
+        return channel, True
+
 
 class ShipToasts(object):
-    """Singleton of shiptoasts for upload processing and retrieval/caching."""
+    """Singleton of shiptoasts for upload processing and retrieval/caching.
+
+    The datastore client, pubsub client, pod lister and clock default to
+    the real ones, they can be replaced to run against fakes instead (see
+    shiptoasting.simulation).
+
+    Caches, subscribers, the index and the queue are only touched while
+    holding self._lock, as the listener, the embed worker, the periodic call
+    and requests may each be on their own thread. Datastore and pubsub calls
+    are made without it.
+    """
 
-    def __init__(self):
-        self.name = os.uname()[1]
+    def __init__(self, name=None, datastore_client=None, pubsub_client=None,
+                 active_pods=all_active_pods, clock=time.time):
+        self.name = name or os.uname()[1]
 
         project = os.environ.get("GCLOUD_DATASET_ID")
         if project == "None":
             project = None
 
-        if project:
+        if datastore_client is not None:
+            self._client = datastore_client
+        elif project:
             self._client = datastore.Client(project=project)
         else:
             self._counter = 0
 
+        self._project = project
+        self._pubsub = pubsub_client
+        self._active_pods = active_pods
+        self._clock = clock
+        self._lock = threading.RLock()
         self._pods = []
+        self._queue = []   # unformatted messages to post to datastore
+        self._channels = ChannelCache()
+        self._channels.allocate(DEFAULT_CHANNEL)
+        self._history = PageCache()
+        self._index = SearchIndex.load()
+        self._embeds = EmbedResolver(cache=EmbedCache(clock=clock))
+        self._limiter = RateLimiter(clock=clock)
+
+        self._age = 0
+
+    def connect(self):
+        """Finds the active pods and ensures our pubsub topic exists."""
 
         if self._update_active_pods() is not None:
-            self._pubsub_client = pubsub.Client(project=project)
+            self._pubsub_client = self._new_pubsub_client()
             self._topic = self._pubsub_client.topic(self.name)
             if not self._topic.exists():
                 self._topic.create()
 
-        self._subs = []  # instances subscribed to changes
-        self._queue = []   # unformatted messages to post to datastore
-        self._cache = ShipToastCache()
+    def load_snapshot(self):
+        """Fills the cache from the local snapshot file, if there is one.
 
-        self._age = 0
+        Returns:
+            boolean of if any shiptoasts were loaded
+        """
+
+        if not SNAPSHOT or not os.path.isfile(SNAPSHOT):
+            return False
+
+        try:
+            with gzip.open(SNAPSHOT, "rt", encoding="utf-8") as opensnapshot:
+                records = json.load(opensnapshot)
+        except (OSError, ValueError) as error:
+            logging.warning("could not load snapshot %s: %r", SNAPSHOT, error)
+            return False
+
+        with self._lock:
+            for record in reversed(records):
+                author, author_id, content, timestamp, _id = record[:5]
+                channel = record[5] if len(record) > 5 else DEFAULT_CHANNEL
+                self._channels.allocate(channel)
+                self._receive(ShipToast(
+                    author,
+                    author_id,
+                    content,
+                    datetime.datetime.fromtimestamp(
+                        timestamp,
+                        tz=datetime.timezone.utc,
+                    ),
+                    _id,
+                    channel,
+                ))
+
+            if hasattr(self, "_counter") and records:
+                self._counter = max(
+                    self._counter,
+                    *(rec[4] for rec in records)
+                )
+
+        return bool(records)
+
+    def save_snapshot(self):
+        """Writes the cache, formatted, to the local snapshot file."""
+
+        if not SNAPSHOT:
+            return
+
+        with self._lock:
+            records = [
+                [st.author, st.author_id, st.content, st.timestamp, st.id,
+                 st.channel]
+                for channel in self._channels.values()
+                for st in channel.cache
+            ]
+        # pods on the same node share the snapshot, but not the temp file
+        temp_file = "{}.{}.tmp".format(SNAPSHOT, self.name)
+        try:
+            with gzip.open(temp_file, "wt", encoding="utf-8") as opensnapshot:
+                json.dump(records, opensnapshot, separators=(",", ":"))
+            os.replace(temp_file, SNAPSHOT)
+        except OSError as error:
+            logging.warning("could not save snapshot %s: %r", SNAPSHOT, error)
+
+    def save_index(self):
+        """Writes the search index to disk, if it has changed.
+
+        The index has a lock of its own, and only writes frozen segments,
+        so this doesn't hold up requests.
+        """
+
+        self._index.save()
+
+    def backfill_index(self):
+        """Pages every shiptoast kind in datastore into the search index.
+
+        Each kind is paged newest first, BACKFILL_PAGE keys at a time with
+        BACKFILL_PAUSE seconds between pages. Only the shiptoasts not yet
+        indexed are fetched. Progress is saved with the index, so a restart
+        picks up where the last pod got to, and later runs only go back to
+        when the last complete run started.
+
+        Only runs on the pod writing the index directory. Without one the
+        whole history would be read again on every restart.
+        """
+
+        if not BACKFILL or not hasattr(self, "_client"):
+            return  # running w/o datastore backend
+
+        if not self._index.take_writer():
+            logging.info("not backfilling, search index is not saved here")
+            return
+
+        try:
+            for kind in self._shiptoast_kinds():
+                while not self._backfill_kind(kind):
+                    pass  # resumed an older run, go again to catch up
+        except Exception:
+            logging.exception("search index backfill failed")
+
+    def _shiptoast_kinds(self):
+        """Returns the datastore kinds holding shiptoasts, of any channel."""
+
+        kinds_query = self._client.query(kind="__kind__")
+        kinds_query.keys_only()
+        kinds = []
+        for entity in kinds_query.fetch():
+            kind = entity.key.name
+            if kind == KIND or (kind.startswith("{}-".format(KIND)) and
+                                channel_pattern.match(kind_channel(kind))):
+                kinds.append(kind)
+        return kinds
+
+    def _backfill_kind(self, kind):
+        """Backfills the search index from one kind (see backfill_index).
+
+        Returns:
+            boolean of if this was a fresh run, rather than a resumed one
+        """
+
+        progress = self._index.backfill.get(kind) or {}
+        cursor = progress.get("cursor")
+        started = progress["started"] if cursor else self._clock()
+        complete = progress.get("complete")
+        channel = kind_channel(kind)
+
+        filters = []
+        if complete is not None:
+            filters.append(("time", ">=", datetime.datetime.fromtimestamp(
+                complete - RECONCILE_LAG,
+                tz=datetime.timezone.utc,
+            )))
+
+        while True:
+            keys_query = self._client.query(
+                kind=kind,
+                order=["-time"],
+                filters=filters,
+            )
+            keys_query.keys_only()
+            entities, _, next_cursor = keys_query.fetch(
+                limit=BACKFILL_PAGE,
+                start_cursor=cursor,
+            ).next_page()
+
+            missing = [
+                entity.key for entity in entities
+                if (channel, entity.key.id) not in self._index
+            ]
+            if missing:
+                self._index.add_segment(
+                    _from_entity(entity)
+                    for entity in self._client.get_multi(missing)
+                )
+
+            if len(entities) < BACKFILL_PAGE or not next_cursor:
+                self._index.set_backfill(kind, {"complete": started})
+                return "cursor" not in progress
+
+            if isinstance(next_cursor, bytes):
+                next_cursor = next_cursor.decode("ascii")
+            cursor = next_cursor
+            self._index.set_backfill(kind, {
+                "cursor": cursor,
+                "started": started,
+                "complete": complete,
+            })
+            time.sleep(BACKFILL_PAUSE)
+
+    def warm_start(self):
+        """Connects and reconciles with datastore, then listens for updates.
+
+        Used when the cache was loaded from a snapshot, so that we can serve
+        while this runs in the background. Failures to connect or fill are
+        logged and retried with backoff, as nothing else would notice them.
+        """
+
+        delay = WARM_START_RETRY
+        while True:
+            try:
+                self.connect()
+                self.initial_fill(False)
+            except Exception:
+                logging.exception("warm start failed, retrying in %ds", delay)
+                time.sleep(delay)
+                delay = min(delay * 2, WARM_START_RETRY_MAX)
+            else:
+                break
+
+        self.listen_for_updates()
 
     def initial_fill(self, update_pods=True):
-        """Query the datastore for all shiptoasts, sort and cache them."""
+        """Query the datastore for the default channel, sort and cache it."""
+
+        self._fill_channel(self._channels[DEFAULT_CHANNEL])
+
+        if update_pods:
+            self._update_active_pods()
+
+    def _fill_channel(self, channel):
+        """Query the datastore for a channel's shiptoasts and cache them."""
 
         if not hasattr(self, "_client"):
             return  # running w/o datastore backend
 
         results = []
-        datastore_query = self._client.query(kind=KIND, order=["-time"])
+        datastore_query = self._client.query(
+            kind=channel.kind,
+            order=["-time"],
+        )
+        filled_at = self._clock()
         try:
             for res in datastore_query.fetch(limit=VISIBLE_POSTS):
-                results.append(ShipToast(
-                    res["author"],
-                    res["author_id"],
-                    format_message(res["content"]),
-                    res["time"],
-                    res.key.id,
-                ))
+                results.append(_from_entity(res))
         except BadRequest as error:
             logging.warning(error)
+            filled_at = None  # fill again on the next reconcile
 
-        known_ids = [st.id for st in self._cache]
-        for res in _time_sorted(results):
-            if res.id not in known_ids and not self._cache.is_spam(res):
-                self._cache.inject(res)
+        self._fill_missing(results)
+        if filled_at is not None:
+            with self._lock:
+                if channel.cursor is None:
+                    # empty, reconcile from now on instead of filling again
+                    channel.cursor = filled_at
 
-        if update_pods:
-            self._update_active_pods()
+    def channel(self, name=DEFAULT_CHANNEL):
+        """Returns a cached channel, allocating and filling it on first use."""
+
+        with self._lock:
+            channel, created = self._channels.allocate(name)
+        if created:
+            self._fill_channel(channel)
+        return channel
 
     def periodic_call(self):
         """Called at regular intervals to clean up our cache."""
@@ -167,19 +601,138 @@ class ShipToasts(object):
             self._remove_old_topics()
 
         # check datastore, fill in anything we might of missed due to race
-        #   condition on startup. can disable entirely after a couple minutes
-        #   except in the case of running in local dev
-        if self._age < 3 or active_pods is None:
-            self.initial_fill(False)
+        #   condition on startup or a dropped pubsub message
+        self.reconcile()
+
+        self._limiter.prune()
+
+        if not self._age % 2:
+            self.save_snapshot()
+            self.save_index()
+
+    def reconcile(self):
+        """Fetches only the shiptoasts in datastore that we haven't seen.
+
+        For each cached channel, does a keys only query from its cursor
+        (minus RECONCILE_LAG seconds to catch late arrivals), then fetches
+        the entities we're missing.
+        """
+
+        if not hasattr(self, "_client"):
+            return  # running w/o datastore backend
+
+        with self._lock:
+            channels = list(self._channels.values())
+
+        for channel in channels:
+            self._reconcile_channel(channel)
+
+    def _reconcile_channel(self, channel):
+        """Reconciles a single channel with datastore (see reconcile)."""
+
+        if channel.cursor is None:
+            return self._fill_channel(channel)
+
+        since = channel.cursor - RECONCILE_LAG
+        with self._lock:
+            channel.seen = {
+                _id: timestamp for _id, timestamp in channel.seen.items()
+                if timestamp >= since
+            }
+            known_ids = set(channel.seen)
+            known_ids.update(st.id for st in channel.cache)
+
+        keys_query = self._client.query(
+            kind=channel.kind,
+            filters=[("time", ">=", datetime.datetime.fromtimestamp(
+                since,
+                tz=datetime.timezone.utc,
+            ))],
+        )
+        keys_query.keys_only()
+        try:
+            missing = [
+                res.key for res in keys_query.fetch()
+                if res.key.id not in known_ids
+            ]
+            if missing:
+                self._fill_missing(
+                    _from_entity(res)
+                    for res in self._client.get_multi(missing)
+                )
+        except BadRequest as error:
+            logging.warning(error)
+
+    def _fill_missing(self, shiptoasts):
+        """Receives any of the shiptoasts not already cached, oldest first."""
+
+        known_ids = {}  # channel name: set of cached or seen shiptoast ids
+        with self._lock:
+            for shiptoast in _time_sorted(shiptoasts):
+                channel = self._channels.peek(shiptoast.channel)
+                if channel is None:
+                    self._receive(shiptoast)
+                    continue
+                if channel.name not in known_ids:
+                    known_ids[channel.name] = set(channel.seen)
+                    known_ids[channel.name].update(
+                        st.id for st in channel.cache
+                    )
+                if shiptoast.id not in known_ids[channel.name]:
+                    known_ids[channel.name].add(shiptoast.id)
+                    self._receive(shiptoast)
+                    self._update_subs(shiptoast)
+
+    def _receive(self, shiptoast):
+        """Caches a shiptoast and advances its channel's reconcile cursor.
+
+        Shiptoasts in channels that aren't cached on this pod are only
+        indexed and recorded against the rate limit. Call with self._lock.
+        """
+
+        shiptoast.content = apply_embeds(
+            shiptoast.content,
+            self._embeds.cached(shiptoast.content),
+        )
+        self._index.add(shiptoast)
+        self._limiter.record(shiptoast.author_id, shiptoast.timestamp)
+
+        channel = self._channels.peek(shiptoast.channel)
+        if channel is None:
+            return
+
+        channel.seen[shiptoast.id] = shiptoast.timestamp
+        if channel.cursor is None or shiptoast.timestamp > channel.cursor:
+            channel.cursor = shiptoast.timestamp
+        if not channel.cache.inject(shiptoast):
+            return  # older than everything cached, no embeds to update
+
+        self._embeds.submit(
+            shiptoast.content,
+            lambda embeds: self._update_embeds(shiptoast, embeds),
+        )
+
+    def _update_embeds(self, shiptoast, embeds):
+        """Applies resolved link embeds to a shiptoast, re-sends it to subs.
+
+        Called from the embed resolver's worker thread. The shiptoast is
+        updated in place so every reference to it sees the new content.
+        It's only re-sent to subs which can replace a shiptoast they were
+        already sent, the others would show it twice.
+        """
+
+        with self._lock:
+            shiptoast.content = apply_embeds(shiptoast.content, embeds)
+            self._update_subs(shiptoast, resend=True)
 
     def _update_active_pods(self):
         """Updates self._pods if there's a KubeAPI available.
 
         Returns:
-            the return from all_active_pods
+            the return from the active_pods function (all_active_pods)
         """
 
-        active_pods = all_active_pods()
+        active_pods = self._active_pods()
         if active_pods is not None:
             self._pods = active_pods
         return active_pods
@@ -220,30 +773,55 @@ class ShipToasts(object):
                 except NotFound:
                     pass
 
-    def listen_for_updates(self):
-        """Sits on a pull sub to fill in live updates."""
+    def _new_pubsub_client(self):
+        """Returns the pubsub client given to us, or a new one."""
+
+        if self._pubsub is not None:
+            return self._pubsub
+        return pubsub.Client(project=self._project)
 
-        sub = pubsub.Client(
-            project=os.environ.get("GCLOUD_DATASET_ID")
-        ).topic(self.name).subscription(self.name)
+    def subscribe(self):
+        """Returns the pull sub on our topic, creating it if needed."""
+
+        sub = self._new_pubsub_client().topic(self.name).subscription(
+            self.name
+        )
 
         if not sub.exists():
             sub.create()
 
+        return sub
+
+    def pull_updates(self, sub):
+        """Pulls from the sub once, fills in the shiptoasts received.
+
+        Messages that can't be read are logged and acknowledged, so they
+        aren't delivered again.
+
+        Returns:
+            the number of messages received
+        """
+
+        messages = sub.pull()
+        for message_id, message in messages:
+            try:
+                shiptoast = _from_message(message.data)
+            except (yaml.YAMLError, KeyError, TypeError, ValueError,
+                    AttributeError) as error:
+                logging.warning("dropping unreadable message %s: %r",
+                                message_id, error)
+            else:
+                self._fill_missing([shiptoast])
+            sub.acknowledge(message_id)
+
+        return len(messages)
+
+    def listen_for_updates(self):
+        """Sits on a pull sub to fill in live updates."""
+
+        sub = self.subscribe()
         while True:
-            for message_id, message in sub.pull():
-                yaml_shiptoast = yaml.load(message.data)
-                shiptoast = ShipToast(
-                    yaml_shiptoast["author"],
-                    yaml_shiptoast["author_id"],
-                    format_message(yaml_shiptoast["content"]),
-                    yaml_shiptoast["time"],
-                    yaml_shiptoast["id"],
-                )
-                if not self._cache.is_spam(shiptoast):
-                    self._cache.inject(shiptoast)
-                    self._update_subs(shiptoast)
-                sub.acknowledge(message_id)
+            self.pull_updates(sub)
 
     def _add_shiptoast(self, shiptoast):
         """Adds a shiptoast to the google datastore.
@@ -253,7 +831,9 @@ class ShipToasts(object):
         """
 
         if hasattr(self, "_client"):
-            entity = datastore.Entity(self._client.key(KIND))
+            entity = datastore.Entity(
+                self._client.key(channel_kind(shiptoast.channel))
+            )
             entity["author"] = shiptoast.author
             entity["author_id"] = shiptoast.author_id
             entity["content"] = shiptoast.content
@@ -267,8 +847,9 @@ class ShipToasts(object):
             else:
                 return entity.key.id
         else:
-            self._counter += 1
-            return self._counter
+            with self._lock:
+                self._counter += 1
+                return self._counter
 
     def _save_pending(self):
         """Tries to save all posts in the queue, requeues failures.
@@ -278,7 +859,8 @@ class ShipToasts(object):
         """
 
         posted_authors = []
-        current, self._queue = self._queue, []
+        with self._lock:
+            current, self._queue = self._queue, []
         for shiptoast in current:
             _id = self._add_shiptoast(shiptoast)
             if _id:
@@ -289,11 +871,13 @@ class ShipToasts(object):
                     format_message(shiptoast.content),
                     shiptoast.time,
                     _id,
+                    shiptoast.channel,
                 )
 
                 # notify ourself clients immediately
-                self._cache.inject(formatted)
-                self._update_subs(formatted)
+                with self._lock:
+                    self._receive(formatted)
+                    self._update_subs(formatted)
 
                 # publish to notify running nodes
                 unformatted = shiptoast._asdict()
@@ -304,24 +888,52 @@ class ShipToasts(object):
                         topic.publish(as_yaml)
                 posted_authors.append(shiptoast.author_id)
             else:
-                self._queue.append(shiptoast)
+                with self._lock:
+                    self._queue.append(shiptoast)
 
         return posted_authors
 
-    def _update_subs(self, shiptoast):
-        """Notify the subs of the shiptoast, removes any that fail."""
+    def _update_subs(self, shiptoast, resend=False):
+        """Notify the shiptoast to subs of its channel, removes any failing.
+
+        When resend is True the shiptoast has been sent before, and only
+        subs with a true resends attribute are notified. Call with
+        self._lock.
+        """
+
+        channel = self._channels.peek(shiptoast.channel)
+        if channel is None:
+            return
 
         to_remove = []
-        for sub in self._subs:
+        for sub in channel.subs:
+            if resend and not getattr(sub, "resends", False):
+                continue
             try:
                 sub.notify(shiptoast)
             except:
                 to_remove.append(sub)
 
         for sub in to_remove:
-            self.remove_sub(sub)
+            self.remove_sub(sub, channel.name)
+
+    def is_spam(self, shiptoast):
+        """Returns a boolean of if a new post should be rejected as spam.
+
+        This is only checked where the post is made, shiptoasts from other
+        pods or datastore are only recorded against the rate limit.
+        """
+
+        if SPAM_ALLOWED:
+            return False
 
-    def add_shiptoast(self, content, author, author_id):
+        channel = self.channel(shiptoast.channel)
+        with self._lock:
+            return channel.cache.is_repeat(shiptoast) or not \
+                self._limiter.allow(shiptoast.author_id, shiptoast.timestamp)
+
+    def add_shiptoast(self, content, author, author_id,
+                      channel=DEFAULT_CHANNEL):
         """Adds a shiptoast to the cache, datastore and pubsub."""
 
         content = _clean_content(content)
@@ -329,37 +941,164 @@ class ShipToasts(object):
             # nothing after cleaning. they should also calm the fuck down
             return []
 
-        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        now = datetime.datetime.fromtimestamp(
+            self._clock(),
+            tz=datetime.timezone.utc,
+        )
 
         # add to the save queue
-        shiptoast = ShipToast(author, author_id, content, now, None)
-        if not self._cache.is_spam(shiptoast):
-            self._queue.append(shiptoast)
+        shiptoast = ShipToast(author, author_id, content, now, None, channel)
+        if not self.is_spam(shiptoast):
+            with self._lock:
+                self._queue.append(shiptoast)
         return self._save_pending()
 
-    def get_shiptoasts(self):
-        """Returns the cached shiptoasts."""
+    def get_shiptoasts(self, channel=DEFAULT_CHANNEL):
+        """Returns a copy of the cached shiptoasts of the channel."""
+
+        cached = self.channel(channel)
+        with self._lock:
+            return list(cached.cache)
+
+    def get_history(self, before, cursor=None, channel=DEFAULT_CHANNEL):
+        """Returns a page of shiptoasts posted before the shiptoast id before.
+
+        Args:
+            before: shiptoast id, the page starts at the next oldest
+            cursor: datastore query cursor from a previous page of before
+            channel: name of the channel the shiptoasts are in
+
+        Returns:
+            tuple of (list of shiptoasts, cursor for the next page or None)
+        """
+
+        key = (channel, before, cursor)
+        with self._lock:
+            page = self._history.get(key)
+        if page is None:
+            page = self._query_history(before, cursor, channel)
+            if hasattr(self, "_client"):
+                with self._lock:
+                    self._history.put(key, page)
+        return page
+
+    def _query_history(self, before, cursor, channel):
+        """Queries datastore for a page of history (see get_history)."""
+
+        cache = self.get_shiptoasts(channel)
+        if not hasattr(self, "_client"):
+            # running w/o datastore backend, page through the cache instead
+            try:
+                offset = int(cursor or 0)
+            except ValueError:
+                abort(400)
+            older = [st for st in cache if st.id < before]
+            page = older[offset:offset + HISTORY_PAGE]
+            if len(older) > offset + HISTORY_PAGE:
+                return page, str(offset + HISTORY_PAGE)
+            return page, None
+
+        before_toast = None
+        for shiptoast in cache:
+            if shiptoast.id == before:
+                before_toast = shiptoast
+                break
+        else:
+            entity = self._client.get(
+                self._client.key(channel_kind(channel), before)
+            )
+            if entity is None:
+                abort(404)
+            before_toast = _from_entity(entity)
+
+        history_query = self._client.query(
+            kind=channel_kind(channel),
+            order=["-time"],
+            filters=[("time", "<", datetime.datetime.fromtimestamp(
+                before_toast.timestamp,
+                tz=datetime.timezone.utc,
+            ))],
+        )
+        try:
+            entities, _, next_cursor = history_query.fetch(
+                limit=HISTORY_PAGE,
+                start_cursor=cursor,
+            ).next_page()
+        except (BadRequest, ValueError) as error:
+            logging.warning("bad history request: %r", error)
+            abort(400)
+
+        if len(entities) < HISTORY_PAGE or not next_cursor:
+            next_cursor = None
+        elif isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode("ascii")
 
-        return self._cache
+        return [_from_entity(entity) for entity in entities], next_cursor
+
+    def search(self, query, page=0, channel=DEFAULT_CHANNEL):
+        """Searches the authors and content of the channel's shiptoasts.
+
+        Returns:
+            tuple of (list of shiptoasts for the page, total matches)
+        """
 
-    def add_sub(self, poster):
-        """Adds a subscriber for updates."""
+        ids, total = self._index.search(query, page, channel=channel)
+        with self._lock:
+            cached = self._channels.peek(channel)
+            found = {
+                st.id: st for st in (cached.cache if cached else [])
+                if st.id in ids
+            }
+        missing = [_id for _id in ids if _id not in found]
+        if missing and hasattr(self, "_client"):
+            kind = channel_kind(channel)
+            try:
+                for entity in self._client.get_multi(
+                        [self._client.key(kind, _id) for _id in missing]):
+                    found[entity.key.id] = _from_entity(entity)
+            except BadRequest as error:
+                logging.warning(error)
+
+        return [found[_id] for _id in ids if _id in found], total
+
+    def add_sub(self, poster, channel=DEFAULT_CHANNEL, fill=True):
+        """Adds a subscriber for updates to the channel.
+
+        A channel that isn't cached yet is filled from datastore first,
+        unless fill is False. It's then left for the next reconcile.
+
+        Returns:
+            a copy of the channel's cache, taken as the subscriber was added
+        """
 
-        self._subs.append(poster)
+        if fill:
+            self.channel(channel)
+        with self._lock:
+            # allocated again in case it was evicted while being filled
+            cached, _ = self._channels.allocate(channel)
+            cached.subs.append(poster)
+            return list(cached.cache)
 
-    def remove_sub(self, poster):
-        """Removes a subscriber from updates."""
+    def remove_sub(self, poster, channel=DEFAULT_CHANNEL):
+        """Removes a subscriber from updates to the channel."""
 
-        self._subs.remove(poster)
+        with self._lock:
+            cached = self._channels.peek(channel)
+            if cached is not None and poster in cached.subs:
+                cached.subs.remove(poster)
 
 
 class ShipToaster(object):
     """Client/thread object."""
 
-    def __init__(self, last_seen_id):
+    fill_channel = True  # if subscribing may fill the channel (blocking)
+
+    def __init__(self, last_seen_id, channel=DEFAULT_CHANNEL, resends=False):
+        self.channel = channel
+        self.resends = resends  # if the client replaces re-sent shiptoasts
 
         # add ourself to subscribers at the same time as checking the cache
-        cache, _ = list(app.shiptoasts._cache), app.shiptoasts.add_sub(self)
+        cache = app.shiptoasts.add_sub(self, channel, self.fill_channel)
 
         seen_index = 0
         for i, cached in enumerate(cache):
@@ -370,10 +1109,9 @@ class ShipToaster(object):
         self.updates = cache[:seen_index]
 
         del cache
-        del _
 
     def __del__(self):
-        app.shiptoasts.remove_sub(self)
+        app.shiptoasts.remove_sub(self, self.channel)
 
     def notify(self, shiptoast):
         """Notify method to receive cached events."""
@@ -392,9 +1130,49 @@ class ShipToaster(object):
             for shiptoast in sent:
                 self.updates.remove(shiptoast)
 
-            heartbeat += 1
+            # only send a heartbeat after 15 seconds with nothing else sent
+            heartbeat = 0 if sent else heartbeat + 1
             if heartbeat > 14:
                 yield HEARTBEAT
                 heartbeat = 0
 
             time.sleep(1)
+
+
+class AsyncShipToaster(ShipToaster):
+    """Client object for streaming from an asyncio event loop.
+
+    Notifications can arrive from any thread, they are handed over to the
+    event loop which owns this client's queue. The channel should be filled
+    (see ShipToasts.channel) in an executor beforehand.
+    """
+
+    fill_channel = False
+
+    def __init__(self, last_seen_id, channel=DEFAULT_CHANNEL, loop=None,
+                 resends=False):
+        self._loop = loop or asyncio.get_event_loop()
+        self._queue = asyncio.Queue()
+        super(AsyncShipToaster, self).__init__(last_seen_id, channel,
+                                               resends)
+
+    def notify(self, shiptoast):
+        """Notify method to receive cached events (thread-safe)."""
+
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, shiptoast)
+
+    def close(self):
+        """Unsubscribes from further updates."""
+
+        app.shiptoasts.remove_sub(self, self.channel)
+
+    async def next_update(self, heartbeat=15):
+        """Returns the next shiptoast, or HEARTBEAT after heartbeat seconds."""
+
+        if self.updates:
+            return self.updates.pop(0)
+
+        try:
+            return await asyncio.wait_for(self._queue.get(), heartbeat)
+        except asyncio.TimeoutError:
+            return HEARTBEAT
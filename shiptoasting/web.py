@@ -3,11 +3,15 @@
 
 import os
 import sys
+import json
+import zlib
 import atexit
 import random
 import traceback
 
 import gevent
+from flask import abort
+from flask import jsonify
 from flask import Response
 from flask import redirect
 from flask import render_template
@@ -18,19 +22,24 @@ from apscheduler.schedulers.gevent import GeventScheduler
 from shiptoasting import app
 from shiptoasting import HEARTBEAT
 from shiptoasting import requires_logged_in
+from shiptoasting.search import SEARCH_PAGE
 from shiptoasting.storage import ShipToasts
 from shiptoasting.storage import ShipToaster
+from shiptoasting.storage import normalize_channel
 
 
 @app.route("/", methods=["GET"])
 def index():
     """Main index. Displays most recent then streams."""
 
-    shiptoasts = app.shiptoasts.get_shiptoasts()
+    channel = request_channel(request.args.get("channel"))
+    shiptoasts = app.shiptoasts.get_shiptoasts(channel)
     return render_template(
         "index.html",
+        channel=channel,
         shiptoasts=shiptoasts,
         last_seen=shiptoasts[0].id if shiptoasts else None,
+        before=shiptoasts[-1].id if shiptoasts else None,
     )
 
 
@@ -39,6 +48,7 @@ def index():
 def add_shiptoast():
     """Accepts the POST form, stores the content."""
 
+    channel = request_channel(request.form.get("channel"))
     post_content = request.form.get("content").strip()
     if post_content:
         if len(post_content) > 500:
@@ -50,6 +60,7 @@ def add_shiptoast():
             post_content,
             session["character"]["CharacterName"],
             session["character"]["CharacterID"],
+            channel,
         )
 
         if session["character"]["CharacterID"] not in posted_authors:
@@ -65,6 +76,8 @@ def add_shiptoast():
                 random.choice(enhance_your_calm_videos)
             ))
 
+    if channel:
+        return redirect("/?channel={}".format(channel))
     return redirect("/")
 
 
@@ -78,38 +91,195 @@ def shiptoasts():
     else:
         last_seen_id = int(last_seen_id)
 
+    channel = request_channel(request.args.get("channel"))
+    encoder = EventEncoder.from_request(
+        request.args.get("mode"),
+        request.headers.get("Accept-Encoding", ""),
+    )
+
     return Response(
-        streaming_shiptoasts(last_seen_id),
+        streaming_shiptoasts(last_seen_id, encoder, channel),
         mimetype="text/event-stream",
+        headers=encoder.headers,
     )
 
 
-def streaming_shiptoasts(last_seen_id):
-    """Iterator to asyncly deliver shiptoasts."""
+@app.route("/shiptoasts/history")
+def shiptoasts_history():
+    """Returns a page of older shiptoasts as JSON or an HTML fragment."""
+
+    try:
+        before = int(request.args["before"])
+    except (KeyError, ValueError):
+        abort(400)
+
+    channel = request_channel(request.args.get("channel"))
+    shiptoasts, cursor = app.shiptoasts.get_history(
+        before,
+        request.args.get("cursor"),
+        channel,
+    )
+
+    if request.args.get("format") == "html":
+        return render_template(
+            "shiptoasts.html",
+            shiptoasts=shiptoasts,
+            before=before if cursor else None,
+            cursor=cursor,
+        )
+
+    return jsonify(
+        shiptoasts=[shiptoast_dict(shiptoast) for shiptoast in shiptoasts],
+        next=cursor,
+    )
+
+
+@app.route("/search")
+def search():
+    """Returns a ranked page of shiptoasts matching the query."""
+
+    query = request.args.get("q", "").strip()
+    try:
+        page = max(int(request.args.get("page", 0)), 0)
+    except ValueError:
+        abort(400)
+
+    channel = request_channel(request.args.get("channel"))
+    shiptoasts, total = app.shiptoasts.search(query, page, channel)
+
+    if request.args.get("format") == "html":
+        return render_template("shiptoasts.html", shiptoasts=shiptoasts)
+
+    return jsonify(
+        shiptoasts=[shiptoast_dict(shiptoast) for shiptoast in shiptoasts],
+        total=total,
+        page=page,
+        next=page + 1 if (page + 1) * SEARCH_PAGE < total else None,
+    )
+
+
+def request_channel(channel):
+    """Returns the normalized channel name from the request, or aborts."""
+
+    try:
+        return normalize_channel(channel)
+    except ValueError:
+        abort(400)
+
+
+def shiptoast_dict(shiptoast):
+    """Returns the JSON serializable fields of a shiptoast for display."""
+
+    return {
+        "id": shiptoast.id,
+        "author": shiptoast.author,
+        "author_id": shiptoast.author_id,
+        "avatar": shiptoast.avatar,
+        "ccp": shiptoast.is_ccp,
+        "content": shiptoast.content,
+        "time": shiptoast.display_time,
+        "timestamp": shiptoast.timestamp,
+    }
 
-    for shiptoast in ShipToaster(last_seen_id).iter():
-        if shiptoast is HEARTBEAT:
-            data = HEARTBEAT
-        else:
-            data = (
-                '{id}%{author}%'
-                '<div class="shiptoaster">'
-                '<div class="prof_pic"><img src='
-                '"https://image.eveonline.com/Character/{author_id}_256.jpg" '
-                'height="256" width="256" alt="{author}" /></div>'
-                '<div class="author{ccp}">{author}</div>'
-                '</div>'
-                '<div class="content">{content}</div>'
-                '<div class="time">{time:%b %e, %H:%M:%S}</div>'
-            ).format(
-                ccp=" ccp" * int(shiptoast.author.startswith("CCP ")),
-                **shiptoast._asdict()
-            )
-        yield "data: {}\n\n".format(data)
+
+def streaming_shiptoasts(last_seen_id, encoder, channel):
+    """Iterator to asyncly deliver a channel's shiptoasts."""
+
+    # only compact clients replace a shiptoast re-sent with its embeds
+    toaster = ShipToaster(last_seen_id, channel, resends=encoder.compact)
+    for shiptoast in toaster.iter():
+        yield encoder.encode(shiptoast)
 
     raise StopIteration
 
 
+class EventEncoder(object):
+    """Encodes shiptoasts for one stream.
+
+    The default mode sends the full markup of each shiptoast. Compact mode
+    sends only the fields as JSON for the page to render, heartbeats as
+    SSE comments, and is gzipped (flushed per event) if the client accepts
+    it. The compressor is kept for the whole stream, so repeated field
+    names and markup cost next to nothing after the first event.
+    """
+
+    def __init__(self, compact=False, compress=False):
+        self.compact = compact
+        self.headers = {"Cache-Control": "no-cache"}
+        if compress:
+            # gzip with a 1 KiB window and memLevel 2, about 12 KiB per
+            # stream instead of 256 KiB. Most repeats are in the last event
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + 10, 2)
+            self.headers["Content-Encoding"] = "gzip"
+        else:
+            self._compressor = None
+
+    @classmethod
+    def from_request(cls, mode, accept_encoding):
+        """Returns an encoder for the mode and Accept-Encoding header."""
+
+        compact = mode == "compact"
+        return cls(compact, compact and "gzip" in accept_encoding)
+
+    def encode(self, shiptoast):
+        """Returns the bytes to write to the stream for shiptoast."""
+
+        if self.compact:
+            event = compact_event(shiptoast)
+        else:
+            event = shiptoast_event(shiptoast)
+
+        if self._compressor is None:
+            return event.encode("utf-8")
+
+        return self._compressor.compress(event.encode("utf-8")) + \
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def compact_event(shiptoast):
+    """Returns the compact (JSON) server-sent event for a shiptoast."""
+
+    if shiptoast is HEARTBEAT:
+        return ":\n\n"
+
+    return "data: {}\n\n".format(json.dumps(
+        {
+            "id": shiptoast.id,
+            "author": shiptoast.author,
+            "author_id": shiptoast.author_id,
+            "time": shiptoast.display_time,
+            "content": shiptoast.content,
+        },
+        separators=(",", ":"),
+    ))
+
+
+def shiptoast_event(shiptoast):
+    """Returns the server-sent event frame for a shiptoast or HEARTBEAT."""
+
+    if shiptoast is HEARTBEAT:
+        data = HEARTBEAT
+    else:
+        data = (
+            '{id}%{author}%'
+            '<div class="shiptoaster">'
+            '<div class="prof_pic"><img src="{avatar}" '
+            'height="256" width="256" alt="{author}" /></div>'
+            '<div class="author{ccp}">{author}</div>'
+            '</div>'
+            '<div class="content">{content}</div>'
+            '<div class="time">{display_time}</div>'
+        ).format(
+            id=shiptoast.id,
+            author=shiptoast.author,
+            avatar=shiptoast.avatar,
+            ccp=" ccp" * int(shiptoast.is_ccp),
+            content=shiptoast.content,
+            display_time=shiptoast.display_time,
+        )
+    return "data: {}\n\n".format(data)
+
+
 def traceback_formatter(excpt, value, tback):
     """Catches all exceptions and re-formats the traceback raised."""
 
@@ -132,13 +302,21 @@ def production(*_, **settings):
     hook_exceptions()
 
     app.shiptoasts = ShipToasts()
-    app.shiptoasts.initial_fill()
+    if app.shiptoasts.load_snapshot():
+        listener = gevent.Greenlet.spawn(app.shiptoasts.warm_start)
+    else:
+        app.shiptoasts.connect()
+        app.shiptoasts.initial_fill()
+        listener = gevent.Greenlet.spawn(app.shiptoasts.listen_for_updates)
+
+    gevent.Greenlet.spawn(app.shiptoasts.backfill_index)
 
     scheduler = GeventScheduler()
     scheduler.add_job(app.shiptoasts.periodic_call, "interval", seconds=30)
     cleaner = scheduler.start()
-    listener = gevent.Greenlet.spawn(app.shiptoasts.listen_for_updates)
 
+    atexit.register(app.shiptoasts.save_snapshot)
+    atexit.register(app.shiptoasts.save_index)
     atexit.register(cleaner.join, timeout=2)
     atexit.register(listener.join, timeout=2)
     atexit.register(scheduler.shutdown)
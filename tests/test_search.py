@@ -0,0 +1,299 @@
+"""Tests for the segmented search index."""
+
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from array import array
+from unittest import mock
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("FLASK_APP_SECRET_KEY", "testing")
+os.environ.setdefault("EVE_SSO_CONFIG", os.path.join(ROOT, "sso-config.json"))
+os.environ.setdefault("EVE_SSO_CALLBACK", "http://localhost/callback")
+
+from shiptoasting import search  # noqa: E402
+from shiptoasting.search import Document  # noqa: E402
+from shiptoasting.search import Segment  # noqa: E402
+from shiptoasting.search import SearchIndex  # noqa: E402
+from shiptoasting.search import synthetic_documents  # noqa: E402
+
+
+def _document(_id, content, channel="", author="pilot", timestamp=None):
+    """Returns a Document, timestamped by id unless given."""
+
+    return Document(author, 1, content, _id, channel,
+                    float(_id if timestamp is None else timestamp))
+
+
+def _write_legacy(path, segment, channel_names):
+    """Writes segment in the format used before postings had channels."""
+
+    tokens = {}
+    for postings in segment.postings.values():
+        for token, (documents, frequencies) in postings.items():
+            merged = tokens.setdefault(token, [])
+            merged.extend(zip(documents, frequencies))
+
+    header = {
+        "byteorder": sys.byteorder,
+        "documents": len(segment),
+        "total_length": sum(segment.lengths),
+        "channels": channel_names,
+        "tokens": [[token, len(tokens[token])] for token in sorted(tokens)],
+    }
+    with gzip.open(path, "wb") as opensegment:
+        opensegment.write(json.dumps(header).encode("utf-8") + b"\n")
+        segment.ids.tofile(opensegment)
+        segment.times.tofile(opensegment)
+        segment.lengths.tofile(opensegment)
+        segment.channels.tofile(opensegment)
+        for token in sorted(tokens):
+            pairs = sorted(tokens[token])
+            array("I", (doc for doc, _ in pairs)).tofile(opensegment)
+            array("B", (tf for _, tf in pairs)).tofile(opensegment)
+
+
+class SegmentTests(unittest.TestCase):
+    """Segment add, merge, write and read."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.documents = list(synthetic_documents(
+            600, seed=1, vocabulary=50, authors=7
+        ))
+        self.names = ["", "c0", "c1", "c2", "c3", "c4"]
+
+    def _segment(self, documents):
+        segment = Segment()
+        for document in documents:
+            segment.add(document, self.names.index(document.channel))
+        return segment
+
+    def assertSegmentsEqual(self, first, second):
+        self.assertEqual(first.ids, second.ids)
+        self.assertEqual(first.times, second.times)
+        self.assertEqual(first.lengths, second.lengths)
+        self.assertEqual(first.channels, second.channels)
+        self.assertEqual(first.postings, second.postings)
+        self.assertEqual(first.stats, second.stats)
+        self.assertEqual(first.newest, second.newest)
+
+    def test_postings_are_per_channel(self):
+        segment = self._segment([
+            _document(1, "fleet up", "c0"),
+            _document(2, "fleet down"),
+            _document(3, "fleet", "c0"),
+        ])
+        self.assertEqual(list(segment.postings[1]["fleet"][0]), [0, 2])
+        self.assertEqual(list(segment.postings[0]["fleet"][0]), [1])
+        self.assertEqual(segment.stats[1][0], 2)
+        self.assertEqual(segment.stats[0][0], 1)
+
+    def test_merged_matches_adding_in_order(self):
+        older = self._segment(self.documents[:250])
+        newer = self._segment(self.documents[250:])
+        self.assertSegmentsEqual(
+            Segment.merged(older, newer),
+            self._segment(self.documents),
+        )
+
+    def test_write_then_read(self):
+        segment = self._segment(self.documents)
+        path = os.path.join(self.directory, "segment-1.gz")
+        segment.write(path, self.names)
+        self.assertFalse(os.path.exists("{}.tmp".format(path)))
+        self.assertSegmentsEqual(
+            Segment.read(path, self.names.index),
+            segment,
+        )
+
+    def test_read_maps_channel_numbers(self):
+        segment = self._segment(self.documents)
+        path = os.path.join(self.directory, "segment-1.gz")
+        segment.write(path, self.names)
+
+        reader_names = ["c4", "c2", ""]
+
+        def _channel_number(name):
+            if name not in reader_names:
+                reader_names.append(name)
+            return reader_names.index(name)
+
+        read = Segment.read(path, _channel_number)
+        for document, channel in enumerate(read.channels):
+            self.assertEqual(
+                reader_names[channel],
+                self.names[segment.channels[document]],
+            )
+        for number, name in enumerate(self.names):
+            self.assertEqual(
+                read.postings[reader_names.index(name)],
+                segment.postings[number],
+            )
+
+    def test_read_splits_legacy_postings(self):
+        segment = self._segment(self.documents)
+        path = os.path.join(self.directory, "legacy.gz")
+        _write_legacy(path, segment, self.names)
+        self.assertSegmentsEqual(
+            Segment.read(path, self.names.index),
+            segment,
+        )
+
+    def test_read_truncated(self):
+        segment = self._segment(self.documents)
+        path = os.path.join(self.directory, "segment-1.gz")
+        segment.write(path, self.names)
+        with gzip.open(path, "rb") as opensegment:
+            data = opensegment.read()
+        with gzip.open(path, "wb") as opensegment:
+            opensegment.write(data[:-10])
+        with self.assertRaises(EOFError):
+            Segment.read(path, self.names.index)
+
+
+class SearchIndexTests(unittest.TestCase):
+    """SearchIndex searching, compaction and persistence."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_small_channel_is_not_starved_by_others(self):
+        index = SearchIndex(None)
+        for _id in range(5):
+            index.add(_document(_id, "fleet", "corp", author="alice"))
+        for _id in range(1000):
+            index.add(_document(_id, "fleet", timestamp=10 + _id))
+
+        with mock.patch.object(search, "SEARCH_PROBES", 100):
+            ids, total = index.search("fleet", channel="corp")
+            self.assertEqual(sorted(ids), list(range(5)))
+            self.assertEqual(total, 5)
+            self.assertEqual(
+                index.search("alice", channel="corp"),
+                index.search("fleet alice", channel="corp"),
+            )
+
+    def test_document_frequencies_are_per_channel(self):
+        index = SearchIndex(None)
+        for _id in range(20):
+            index.add(_document(_id, "fleet rare" if _id < 2 else "fleet",
+                                "corp"))
+        for _id in range(500):
+            index.add(_document(_id, "rare"))
+
+        # rare only matters where it's rare, ranking it above plain fleet
+        ids, total = index.search("fleet", page_size=2, channel="corp")
+        self.assertEqual(total, 20)
+        ids, _ = index.search("rare fleet", channel="corp")
+        self.assertEqual(sorted(ids), [0, 1])
+
+    def test_ids_are_per_channel(self):
+        index = SearchIndex(None)
+        index.add(_document(1, "fleet", "corp"))
+        index.add(_document(1, "fleet"))
+        index.add(_document(1, "fleet again"))
+        self.assertEqual(len(index), 2)
+        self.assertIn(("corp", 1), index)
+        self.assertNotIn(("corp", 2), index)
+
+    def test_capped_search_estimates_total(self):
+        index = SearchIndex(None)
+        for _id in range(3000):
+            index.add(_document(_id, "fleet" if _id % 3 else "fleet ops"))
+
+        with mock.patch.object(search, "SEARCH_CANDIDATES", 100):
+            ids, total = index.search("ops")
+        self.assertEqual(len(ids), search.SEARCH_PAGE)
+        self.assertTrue(900 <= total <= 1100, total)
+        # the newest matches are the ones ranked
+        self.assertTrue(min(ids) > 2500)
+
+    def test_compacted_search_matches_single_segment(self):
+        documents = list(synthetic_documents(2000, seed=2, vocabulary=80))
+        single = SearchIndex(None)
+        segmented = SearchIndex(None)
+        for number, document in enumerate(documents):
+            single.add(document)
+            segmented.add(document)
+            if not number % 150:
+                segmented.save()
+        segmented.add_segment(documents[:400])  # all known already
+        segmented.save()
+        self.assertTrue(
+            1 < len(segmented._segments) <= search.SEARCH_SEGMENTS
+        )
+
+        # capped totals are estimated per segment, so compare uncapped
+        with mock.patch.object(search, "SEARCH_CANDIDATES", 10 ** 6):
+            for query in ("w0", "w1 w2", "pilot w3", "w79", "nothing"):
+                for channel in ("", "c1"):
+                    for page in (0, 2):
+                        self.assertEqual(
+                            segmented.search(query, page, channel=channel),
+                            single.search(query, page, channel=channel),
+                        )
+
+    def test_save_is_incremental_and_loads(self):
+        path = os.path.join(self.directory, "index")
+        documents = list(synthetic_documents(1200, seed=3, vocabulary=60))
+        index = SearchIndex(path)
+        for document in documents[:1000]:
+            index.add(document)
+        index.set_backfill("shiptoast", {"complete": 5})
+        index.save()
+        written = set(os.listdir(path))
+
+        for document in documents[1000:]:
+            index.add(document)
+        index.save()
+        new = set(os.listdir(path)) - written
+        self.assertEqual(len(new), 1)
+
+        loaded = SearchIndex.load(path)
+        self.assertEqual(len(loaded), len(index))
+        self.assertFalse(loaded.dirty)
+        self.assertEqual(loaded.backfill, {"shiptoast": {"complete": 5}})
+        for query in ("w0", "w4 w5", "pilot"):
+            self.assertEqual(loaded.search(query, channel="c3"),
+                             index.search(query, channel="c3"))
+
+    def test_only_one_writer(self):
+        path = os.path.join(self.directory, "index")
+        writer = SearchIndex(path)
+        writer.add(_document(1, "fleet"))
+        writer.save()
+        self.assertTrue(writer.take_writer())
+
+        other = SearchIndex.load(path)
+        other.add(_document(2, "fleet"))
+        other.save()
+        self.assertFalse(other.take_writer())
+        self.assertEqual(len(SearchIndex.load(path)), 1)
+        self.assertFalse(SearchIndex(None).take_writer())
+
+    def test_loads_legacy_file(self):
+        segment = Segment()
+        for _id in range(10):
+            segment.add(_document(_id, "fleet"), 0)
+        path = os.path.join(self.directory, "index")
+        _write_legacy(path, segment, [""])
+
+        index = SearchIndex.load(path)
+        self.assertTrue(index.dirty)
+        self.assertEqual(index.search("fleet")[1], 10)
+        index.save()
+        self.assertTrue(os.path.isdir(path))
+        self.assertEqual(SearchIndex.load(path).search("fleet")[1], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Tests for reading shiptoasts published between pods."""
+
+
+import os
+import datetime
+import unittest
+from collections import namedtuple
+
+import yaml
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("FLASK_APP_SECRET_KEY", "testing")
+os.environ.setdefault("EVE_SSO_CONFIG", os.path.join(ROOT, "sso-config.json"))
+os.environ.setdefault("EVE_SSO_CALLBACK", "http://localhost/callback")
+
+from shiptoasting.storage import ShipToast  # noqa: E402
+from shiptoasting.storage import ShipToasts  # noqa: E402
+
+
+Message = namedtuple("Message", ("data",))
+
+# as published by pods on python 3.5, where _asdict() is an OrderedDict
+BASELINE_MESSAGE = b"""\
+!!python/object/apply:collections.OrderedDict
+- - [author, Old Pilot]
+  - [author_id, 1]
+  - [content, 'fleet: up']
+  - [time, 2016-04-01 12:00:00.000005]
+  - [id, 7]
+"""
+
+
+class FakeSubscription(object):
+    """Pubsub subscription returning messages once, recording acks."""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.acknowledged = []
+
+    def pull(self):
+        messages, self.messages = self.messages, []
+        return messages
+
+    def acknowledge(self, message_id):
+        self.acknowledged.append(message_id)
+
+
+class Subscriber(object):
+    """Records the shiptoasts it's notified of."""
+
+    def __init__(self):
+        self.received = []
+
+    def notify(self, shiptoast):
+        self.received.append(shiptoast)
+
+
+class PullUpdatesTests(unittest.TestCase):
+    """ShipToasts.pull_updates with messages from old and new pods."""
+
+    def setUp(self):
+        self.shiptoasts = ShipToasts()
+        self.subscriber = Subscriber()
+        self.shiptoasts.add_sub(self.subscriber)
+
+    def _current_message(self, _id, content):
+        unformatted = ShipToast(
+            "New Pilot",
+            2,
+            content,
+            datetime.datetime(2016, 4, 1, 12, 0, 1),
+            None,
+        )._asdict()
+        unformatted["id"] = _id
+        return Message(bytes(yaml.dump(unformatted), encoding="utf-8"))
+
+    def test_reads_old_and_new_pods(self):
+        sub = FakeSubscription([
+            ("a", Message(BASELINE_MESSAGE)),
+            ("b", self._current_message(8, "fleet: down")),
+        ])
+        self.assertEqual(self.shiptoasts.pull_updates(sub), 2)
+        self.assertEqual(sub.acknowledged, ["a", "b"])
+        self.assertEqual(
+            [(st.id, st.author) for st in self.subscriber.received],
+            [(7, "Old Pilot"), (8, "New Pilot")],
+        )
+        self.assertEqual(self.subscriber.received[0].content, "fleet: up")
+
+    def test_acknowledges_unreadable_messages(self):
+        sub = FakeSubscription([
+            ("a", Message(b"{author: [")),
+            ("b", Message(b"- not a shiptoast")),
+            ("c", Message(b"!!python/object/apply:os.system [exit 1]")),
+            ("d", Message(b"{author: x, author_id: 1, content: y}")),
+            ("e", self._current_message(9, "still here")),
+        ])
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(self.shiptoasts.pull_updates(sub), 5)
+        self.assertEqual(len(logs.records), 4)
+        self.assertEqual(sub.acknowledged, ["a", "b", "c", "d", "e"])
+        self.assertEqual([st.id for st in self.subscriber.received], [9])
+
+
+if __name__ == "__main__":
+    unittest.main()